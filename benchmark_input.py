@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import tensorflow as tf
+import argparse
+import time
+
+from models.font2font_cgan_patchgan import Font2Font
+from util.dataset import TrainDataProvider
+from util.tfdata import TrainPipeline
+
+parser = argparse.ArgumentParser(description='Compare training steps/sec of feed_dict and tf.data input')
+parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
+                    help='experiment directory, the packaged examples are read from its data directory')
+parser.add_argument('--image_size', dest='image_size', type=int, default=256,
+                    help="size of your input and output image")
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='number of examples in batch')
+parser.add_argument('--steps', dest='steps', type=int, default=100, help='number of timed training steps')
+parser.add_argument('--warmup', dest='warmup', type=int, default=10,
+                    help='number of training steps before the timing starts')
+parser.add_argument('--uint8_input', dest='uint8_input', type=int, default=0,
+                    help='feed uint8 batches and normalize them in the graph')
+parser.add_argument('--prefetch', dest='prefetch', type=int, default=0,
+                    help='number of batches prepared ahead in the background for feed_dict')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of background workers preparing batches for feed_dict, used with --prefetch')
+
+args = parser.parse_args()
+
+
+def run_steps(input_pipeline):
+    """
+    Steps/sec of the train loop step, one D and two G updates, with batches fed by
+    feed_dict or read by the tf.data pipeline
+    """
+    tf.reset_default_graph()
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    with tf.Session(config=config) as sess:
+        model = Font2Font(args.experiment_dir, batch_size=args.batch_size, input_width=args.image_size,
+                          output_width=args.image_size, uint8_input=args.uint8_input,
+                          input_pipeline=input_pipeline)
+        model.register_session(sess)
+        model.build_model(is_training=True)
+        g_vars, d_vars = model.retrieve_trainable_vars()
+        input_handle, loss_handle, _, _ = model.retrieve_handles()
+        learning_rate = tf.placeholder(tf.float32, name="learning_rate")
+        d_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.d_loss, var_list=d_vars)
+        g_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.g_loss, var_list=g_vars)
+        tf.global_variables_initializer().run()
+
+        pipeline = None
+        if input_pipeline:
+            data_provider = TrainDataProvider(model.data_dir, uint8=args.uint8_input)
+            pipeline = TrainPipeline(data_provider.train.examples, args.batch_size, args.image_size,
+                                     uint8=args.uint8_input, batch=model.pipeline_batch)
+        else:
+            data_provider = TrainDataProvider(model.data_dir, prefetch=args.prefetch, num_workers=args.num_workers,
+                                              uint8=args.uint8_input)
+
+        def batches():
+            while True:
+                if pipeline is not None:
+                    epoch_iter = pipeline.batch_iter(sess)
+                else:
+                    epoch_iter = data_provider.get_train_iter(args.batch_size)
+                for batch in epoch_iter:
+                    yield batch
+
+        steps = 0
+        start = None
+        for batch in batches():
+            if steps == args.warmup:
+                start = time.time()
+            if steps == args.warmup + args.steps:
+                break
+            feed = {learning_rate: 0.001}
+            if batch is not None:
+                feed.update({input_handle.real_data: batch, input_handle.no_target_data: batch})
+            sess.run([d_optimizer, loss_handle.d_loss], feed_dict=feed)
+            sess.run([g_optimizer, loss_handle.g_loss], feed_dict=feed)
+            sess.run([g_optimizer, loss_handle.g_loss], feed_dict=feed)
+            steps += 1
+        passed = time.time() - start
+        data_provider.close()
+    return args.steps / passed
+
+
+def main(_):
+    feed_rate = run_steps(input_pipeline=False)
+    pipeline_rate = run_steps(input_pipeline=True)
+    print("feed_dict: %.2f steps/sec" % feed_rate)
+    print("tf.data: %.2f steps/sec (%.2fx)" % (pipeline_rate, pipeline_rate / feed_rate))
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import tensorflow as tf
+import argparse
+
+from models.font2font_cgan_patchgan import Font2Font
+from util.progressive import parse_widths, train_progressive
+
+parser = argparse.ArgumentParser(description='Compare the time to a target val l1_loss of fixed width and '
+                                             'progressive training')
+parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
+                    help='experiment directory, the packaged examples are read from its data directory')
+parser.add_argument('--experiment_id', dest='experiment_id', type=int, default=0,
+                    help='experiment id of the fixed width run, the progressive run takes the next one')
+parser.add_argument('--image_size', dest='image_size', type=int, default=256,
+                    help="size of your input and output image")
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='number of examples in batch')
+parser.add_argument('--lr', dest='lr', type=float, default=0.001, help='initial learning rate for adam')
+parser.add_argument('--target_l1', dest='target_l1', type=float, required=True,
+                    help='val l1_loss both runs train to')
+parser.add_argument('--epoch', dest='epoch', type=int, default=100,
+                    help='maximum number of epochs at image_size')
+parser.add_argument('--progressive_widths', dest='progressive_widths', type=str, default='64,128',
+                    help='comma separated lower widths trained in turn before image_size')
+parser.add_argument('--stage_epochs', dest='stage_epochs', type=int, default=5,
+                    help='number of epochs of each of --progressive_widths')
+
+args = parser.parse_args()
+
+
+def model_builder(experiment_id):
+    """
+    build_model of train_progressive, the runs have their own experiment id and checkpoints
+    """
+    def build_model(sess, width):
+        model = Font2Font(args.experiment_dir, experiment_id=experiment_id, batch_size=args.batch_size,
+                          input_width=width, output_width=width, data_width=args.image_size)
+        model.register_session(sess)
+        model.build_model(is_training=True)
+        return model
+
+    return build_model
+
+
+def main(_):
+    # both runs are timed by the train loop seconds train() reports, without the setup of a stage
+    train_args = dict(lr=args.lr, resume=False)
+    widths = parse_widths(args.progressive_widths)
+    fixed = train_progressive(model_builder(args.experiment_id), [args.image_size], 0, args.epoch,
+                              target_l1=args.target_l1, **train_args)
+    progressive = train_progressive(model_builder(args.experiment_id + 1), widths + [args.image_size],
+                                    args.stage_epochs, args.epoch, target_l1=args.target_l1, **train_args)
+
+    def report(name, seconds):
+        if seconds is None:
+            print("%s: l1_loss %.5f not reached in %d epochs" % (name, args.target_l1, args.epoch))
+        else:
+            print("%s: l1_loss %.5f reached in %.1f sec of training" % (name, args.target_l1, seconds))
+
+    report("fixed %d" % args.image_size, fixed)
+    report("progressive %s" % ",".join(str(w) for w in widths + [args.image_size]), progressive)
+    if fixed is not None and progressive is not None:
+        print("speedup: %.2fx" % (fixed / progressive))
+
+
+if __name__ == '__main__':
+    tf.app.run()
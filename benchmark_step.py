@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import tensorflow as tf
+import argparse
+import time
+
+from models.font2font_cgan_patchgan import Font2Font
+from util.dataset import TrainDataProvider
+from util.ops import fused_train_op
+
+parser = argparse.ArgumentParser(description='Compare training steps/sec of the three run and the fused step')
+parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
+                    help='experiment directory, the packaged examples are read from its data directory')
+parser.add_argument('--image_size', dest='image_size', type=int, default=256,
+                    help="size of your input and output image")
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='number of examples in batch')
+parser.add_argument('--steps', dest='steps', type=int, default=100, help='number of timed training steps')
+parser.add_argument('--warmup', dest='warmup', type=int, default=10,
+                    help='number of training steps before the timing starts')
+
+args = parser.parse_args()
+
+
+def run_steps(fused, g_updates=2):
+    """
+    Steps/sec of the train loop step on one fixed batch, the D update and two G updates
+    in three runs, or the fused D and G update plus g_updates - 1 G updates
+    """
+    tf.reset_default_graph()
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    with tf.Session(config=config) as sess:
+        model = Font2Font(args.experiment_dir, batch_size=args.batch_size, input_width=args.image_size,
+                          output_width=args.image_size)
+        model.register_session(sess)
+        model.build_model(is_training=True)
+        g_vars, d_vars = model.retrieve_trainable_vars()
+        input_handle, loss_handle, _, _ = model.retrieve_handles()
+        learning_rate = tf.placeholder(tf.float32, name="learning_rate")
+        d_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        g_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        d_optimizer = d_adam.minimize(loss_handle.d_loss, var_list=d_vars)
+        g_optimizer = g_adam.minimize(loss_handle.g_loss, var_list=g_vars)
+        fused_optimizer = fused_train_op(d_adam, loss_handle.d_loss, d_vars, g_adam, loss_handle.g_loss, g_vars)
+        tf.global_variables_initializer().run()
+
+        data_provider = TrainDataProvider(model.data_dir)
+        batch = next(data_provider.get_train_iter(args.batch_size))
+        feed = {learning_rate: 0.001, input_handle.real_data: batch, input_handle.no_target_data: batch}
+
+        start = None
+        for step in range(args.warmup + args.steps):
+            if step == args.warmup:
+                start = time.time()
+            if fused:
+                sess.run([fused_optimizer, loss_handle.d_loss, loss_handle.g_loss], feed_dict=feed)
+                for _ in range(g_updates - 1):
+                    sess.run(g_optimizer, feed_dict=feed)
+            else:
+                sess.run([d_optimizer, loss_handle.d_loss], feed_dict=feed)
+                sess.run([g_optimizer, loss_handle.g_loss], feed_dict=feed)
+                sess.run([g_optimizer, loss_handle.g_loss], feed_dict=feed)
+        passed = time.time() - start
+    return args.steps / passed
+
+
+def main(_):
+    three_runs = run_steps(fused=False)
+    print("three runs: %.2f steps/sec" % three_runs)
+    for g_updates in (2, 1):
+        rate = run_steps(fused=True, g_updates=g_updates)
+        print("fused, %d G updates: %.2f steps/sec (%.2fx)" % (g_updates, rate, rate / three_runs))
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -9,7 +9,13 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 import json
-import collections
+import time
+from collections import OrderedDict
+from io import BytesIO
+from multiprocessing import Pool
+from util.fontcoverage import FontCoverage, NOTDEF_PROBE
+from util.container import ExampleWriter, Manifest, SplitPolicy, SPLIT_MODES
+from util.glyphstore import GlyphStore, GlyphCache, font_file_hash
 
 CN_CHARSET = None
 CN_T_CHARSET = None
@@ -18,6 +24,9 @@ KR_CHARSET = None
 
 DEFAULT_CHARSET = "./charset/cjk.json"
 
+# fonts and render settings of a rendering pool worker, loaded once per process
+_worker_render_args = None
+
 
 def load_charset(char_dir):
     with open(char_dir, 'r') as f:
@@ -35,21 +44,30 @@ def load_global_charset():
     CN_T_CHARSET = cjk["gb2312_t"]
 
 
-def draw_single_char(ch, font, canvas_size, x_offset, y_offset):
+def draw_single_char(ch, font, canvas_size, x_offset, y_offset, store=None):
+    if store is not None:
+        key = store.key(ch, font, canvas_size, x_offset, y_offset)
+        img = store.get(key)
+        if img is not None:
+            return img
     # img = Image.new("RGB", (canvas_size, canvas_size), (255, 255, 255))
     img = Image.new("L", (canvas_size, canvas_size), 255)
     draw = ImageDraw.Draw(img)
     draw.text((x_offset, y_offset), ch, 0, font=font)
+    if store is not None:
+        store.put(key, img)
     return img
 
 
-def draw_example(ch, src_font, dst_font, canvas_size, x_offset, y_offset, filter_hashes):
-    dst_img = draw_single_char(ch, dst_font, canvas_size, x_offset, y_offset)
-    # check the filter example in the hashes or not
-    dst_hash = hash(dst_img.tobytes())
-    if dst_hash in filter_hashes:
+def draw_example(ch, src_font, dst_font, canvas_size, x_offset, y_offset, coverage=None, store=None):
+    # skip the characters missing in the target font before rendering anything
+    if coverage is not None and not coverage.has_glyph(ch):
+        return None
+    dst_img = draw_single_char(ch, dst_font, canvas_size, x_offset, y_offset, store=store)
+    # mapped to an empty or .notdef glyph
+    if coverage is not None and coverage.is_missing_bitmap(dst_img):
         return None
-    src_img = draw_single_char(ch, src_font, canvas_size, x_offset, y_offset)
+    src_img = draw_single_char(ch, src_font, canvas_size, x_offset, y_offset, store=store)
     # example_img = Image.new("RGB", (canvas_size * 2, canvas_size), (255, 255, 255))
     example_img = Image.new("L", (canvas_size * 2, canvas_size), 255)
     example_img.paste(dst_img, (0, 0))
@@ -57,48 +75,202 @@ def draw_example(ch, src_font, dst_font, canvas_size, x_offset, y_offset, filter
     return example_img
 
 
-def filter_recurring_hash(charset, font, canvas_size, x_offset, y_offset):
-    """ Some characters are missing in a given font, filter them
-    by checking the recurring hashes
+def build_coverage(font_path, font, canvas_size, x_offset, y_offset):
+    """ Some characters are missing in a given font, index the glyphs
+    of the font by its cmap and remember how its .notdef box looks like
     """
-    _charset = charset[:]
-    np.random.shuffle(_charset)
-    sample = _charset[:2000]
-    hash_count = collections.defaultdict(int)
-    for c in sample:
-        img = draw_single_char(c, font, canvas_size, x_offset, y_offset)
-        hash_count[hash(img.tobytes())] += 1
-    recurring_hashes = filter(lambda d: d[1] > 2, hash_count.items())
-    return [rh[0] for rh in recurring_hashes]
+    coverage = FontCoverage(font_path)
+    coverage.add_notdef_bitmap(draw_single_char(NOTDEF_PROBE, font, canvas_size, x_offset, y_offset))
+    return coverage
 
 
-def font2img(src, dst, charset, char_size, canvas_size,
-             x_offset, y_offset, sample_dir, label=0, filter_by_hash=True):
+def encode_example(example_img):
+    """ Encode an example into the same jpeg bytes as saving it to a .jpg file
+    """
+    buf = BytesIO()
+    example_img.save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def init_render_worker(src, dsts, char_size, canvas_size, x_offset, y_offset, coverages,
+                       cache_dir=None, cache_bytes=1 << 30):
+    global _worker_render_args
     src_font = ImageFont.truetype(src, size=char_size)
-    dst_font = ImageFont.truetype(dst, size=char_size)
+    dst_fonts = [ImageFont.truetype(dst, size=char_size) for dst in dsts]
+    # the source glyph of a char is rendered once and paired with every target font,
+    # chars are rendered one after another so a small store is enough
+    if cache_dir:
+        store = GlyphCache(cache_dir, max_bytes=cache_bytes)
+    else:
+        store = GlyphStore(capacity=64)
+    _worker_render_args = (src_font, dst_fonts, canvas_size, x_offset, y_offset, coverages, store)
 
-    filter_hashes = set()
-    if filter_by_hash:
-        filter_hashes = set(filter_recurring_hash(charset, dst_font, canvas_size, x_offset, y_offset))
-        print("filter hashes -> %s" % (",".join([str(h) for h in filter_hashes])))
 
-    count = 0
+def render_encoded_example(ch):
+    """ Encoded example of ch for every target font, None for the targets that skip ch,
+    along with the glyph store hits and misses of ch
+    """
+    src_font, dst_fonts, canvas_size, x_offset, y_offset, coverages, store = _worker_render_args
+    hits, misses = store.hits, store.misses
+    encoded = list()
+    for dst_font, coverage in zip(dst_fonts, coverages):
+        e = draw_example(ch, src_font, dst_font, canvas_size, x_offset, y_offset, coverage, store)
+        encoded.append(encode_example(e) if e is not None else None)
+    return encoded, store.hits - hits, store.misses - misses
 
-    for c in charset:
-        e = draw_example(c, src_font, dst_font, canvas_size, x_offset, y_offset, filter_hashes)
-        if e:
-            e.save(os.path.join(sample_dir, "%d_%04d.jpg" % (label, count)))
-            count += 1
-            if count % 100 == 0:
-                print("processed %d chars" % count)
+
+def render_examples(src, dsts, charset, char_size, canvas_size, x_offset, y_offset, coverages, num_workers=1,
+                    cache_dir=None, cache_bytes=1 << 30):
+    """ Yield the encoded examples of every char in charset order, one entry per target
+    font and None for the skipped chars, with the glyph store hits and misses
+    """
+    render_args = (src, dsts, char_size, canvas_size, x_offset, y_offset, coverages, cache_dir, cache_bytes)
+    if num_workers > 1:
+        # shard the charset over the pool, every worker loads its own fonts, renders and
+        # encodes the examples, results come back in charset order so the file names
+        # and labels are the same as in the serial path
+        pool = Pool(num_workers, initializer=init_render_worker, initargs=render_args)
+        try:
+            chunksize = max(1, len(charset) // (num_workers * 16))
+            for rendered in pool.imap(render_encoded_example, charset, chunksize=chunksize):
+                yield rendered
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_render_worker(*render_args)
+        for c in charset:
+            yield render_encoded_example(c)
+
+
+def font2img_multi(src, dsts, charset, char_size, canvas_size, x_offset, y_offset, sample_dirs,
+                   label=0, filter_missing=True, num_workers=1, save_dirs=None, train_val_split=0.1,
+                   cache_dir=None, cache_bytes=1 << 30, rebuild=False, split_policy=None):
+    """ Pair the source font with several target fonts, every source glyph is rendered
+    once for all the targets. The examples of dsts[i] go to sample_dirs[i] as %d_%04d.jpg
+    files, or if save_dirs is given, straight into save_dirs[i]/train.obj and val.obj.
+    With cache_dir the glyph rasters are kept in a persistent GlyphCache across runs.
+
+    Every output directory keeps a manifest of its characters. Unless rebuild is set, a
+    rerun only renders and appends the characters added to charset and tombstones the
+    removed ones, the existing examples and their train/val split stay untouched. The
+    characters a target font does not have are recorded as missing and not rendered again
+    until the source or the target font changes. A rebuild of sample_dirs removes their
+    old %d_*.jpg files of label, the ids start at 0 again
+    """
+    coverages = [None] * len(dsts)
+    if filter_missing:
+        for i, dst in enumerate(dsts):
+            dst_font = ImageFont.truetype(dst, size=char_size)
+            coverages[i] = build_coverage(dst, dst_font, canvas_size, x_offset, y_offset)
+            print("target font %s covers %d code points" % (dst, len(coverages[i])))
+
+    out_dirs = save_dirs or sample_dirs
+    manifests = [Manifest.for_dir(d, load=not rebuild) for d in out_dirs]
+    if rebuild and not save_dirs:
+        # the new files reuse the ids from 0 on, none of the old numbering may be packaged along
+        for d in sample_dirs:
+            for name in os.listdir(d):
+                if name.startswith("%d_" % label) and name.endswith(".jpg"):
+                    os.remove(os.path.join(d, name))
+    added = list()
+    for d, dst, manifest in zip(out_dirs, dsts, manifests):
+        manifest.track_missing_fonts([font_file_hash(src), font_file_hash(dst)])
+        chars_added, chars_removed = manifest.diff(charset)
+        for c in chars_removed:
+            record = manifest.remove(c)
+            if not save_dirs and os.path.exists(os.path.join(d, record["source"])):
+                os.remove(os.path.join(d, record["source"]))
+        print("%s: %d chars to add, %d chars removed" % (d, len(chars_added), len(chars_removed)))
+        added.append(set(chars_added))
+    render_charset = [c for c in OrderedDict.fromkeys(charset) if any(c in chars for chars in added)]
+
+    writers = None
+    if save_dirs:
+        writers = [ExampleWriter(os.path.join(d, "train.obj"), os.path.join(d, "val.obj"),
+                                 train_val_split=train_val_split, append=manifest.exists() and not rebuild,
+                                 split_policy=split_policy)
+                   for d, manifest in zip(save_dirs, manifests)]
+
+    counts = [0] * len(dsts)
+    processed = 0
+    hits, misses = 0, 0
+    start = time.time()
+    try:
+        rendered = render_examples(src, dsts, render_charset, char_size, canvas_size, x_offset, y_offset,
+                                   coverages, num_workers, cache_dir, cache_bytes)
+        for c, (encoded, char_hits, char_misses) in zip(render_charset, rendered):
+            hits += char_hits
+            misses += char_misses
+            for i, e_bytes in enumerate(encoded):
+                if c not in added[i]:
+                    continue
+                if not e_bytes:
+                    # not in the target font, a rerun does not render it again
+                    manifests[i].add_missing(c)
+                    continue
+                if writers:
+                    split, index = writers[i].write(e_bytes, label=label, char=c)
+                    manifests[i].add(c, e_bytes, split=split, index=index)
+                else:
+                    name = "%d_%04d.jpg" % (label, manifests[i].next_id)
+                    with open(os.path.join(sample_dirs[i], name), 'wb') as f:
+                        f.write(e_bytes)
+                    manifests[i].add(c, e_bytes, source=name)
+                counts[i] += 1
+            processed += 1
+            if processed % 100 == 0:
+                print("processed %d chars, %.1f chars/sec" % (processed, processed / (time.time() - start)))
+    finally:
+        if writers:
+            for writer in writers:
+                writer.close()
+        # only what has been written is recorded, an interrupted run resumes from there
+        for manifest in manifests:
+            manifest.save()
+
+    passed = time.time() - start
+    for dst, count, manifest in zip(dsts, counts, manifests):
+        print("rendered %d of %d chars for %s, %d chars in total" % (count, len(render_charset), dst, len(manifest)))
+    print("rendered %d chars for %d target fonts in %.2fs, %.1f chars/sec" % (len(render_charset), len(dsts), passed,
+                                                                             len(render_charset) / max(passed, 1e-6)))
+    print("glyph %s: %d hits, %d misses, hit rate %.1f%%" % ("cache" if cache_dir else "store", hits, misses,
+                                                               100.0 * hits / max(hits + misses, 1)))
+    if cache_dir:
+        # workers only account for their own writes, bring the shared cache under budget
+        cache = GlyphCache(cache_dir, max_bytes=cache_bytes, memory_capacity=0)
+        cache.trim()
+        print("glyph cache %s holds %d glyphs, %.1f MB" % (cache_dir, len(cache), cache.total_bytes / 1048576.0))
+    return counts
+
+
+def font2img(src, dst, charset, char_size, canvas_size,
+             x_offset, y_offset, sample_dir, label=0, filter_missing=True, num_workers=1,
+             save_dir=None, train_val_split=0.1, cache_dir=None, cache_bytes=1 << 30, rebuild=False,
+             split_policy=None):
+    """ Render the examples of charset into sample_dir as %d_%04d.jpg files, or if save_dir is
+    given, straight into save_dir/train.obj and save_dir/val.obj without any per-glyph file
+    """
+    counts = font2img_multi(src, [dst], charset, char_size, canvas_size, x_offset, y_offset, [sample_dir],
+                            label=label, filter_missing=filter_missing, num_workers=num_workers,
+                            save_dirs=[save_dir] if save_dir else None, train_val_split=train_val_split,
+                            cache_dir=cache_dir, cache_bytes=cache_bytes, rebuild=rebuild,
+                            split_policy=split_policy)
+    return counts[0]
+
+
+def target_dir(out_dir, dst):
+    # one sub directory per target font, named after the font file
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(dst))[0])
 
 
 # load_global_charset()
 parser = argparse.ArgumentParser(description='Convert font to images')
 parser.add_argument('--char_dir', dest='char_dir', required=True, help='path of the characters')
 parser.add_argument('--src_font', dest='src_font', required=True, help='path of the source font')
-parser.add_argument('--dst_font', dest='dst_font', required=True, help='path of the target font')
-parser.add_argument('--filter', dest='filter', type=int, default=0, help='filter recurring characters')
+parser.add_argument('--dst_font', dest='dst_font', required=True, nargs='+',
+                    help='path of the target font, with several fonts every one gets its own sub directory')
+parser.add_argument('--filter', dest='filter', type=int, default=0, help='filter characters missing in the target font')
 parser.add_argument('--charset', dest='charset', type=str, default='CN',
                     help='charset, can be either: CN, JP, KR or a one line file')
 parser.add_argument('--shuffle', dest='shuffle', type=int, default=0, help='shuffle a charset before processings')
@@ -107,19 +279,56 @@ parser.add_argument('--canvas_size', dest='canvas_size', type=int, default=256,
 parser.add_argument('--x_offset', dest='x_offset', type=int, default=0, help='x offset')
 parser.add_argument('--y_offset', dest='y_offset', type=int, default=0, help='y_offset')
 parser.add_argument('--sample_dir', dest='sample_dir', help='directory to save examples')
+parser.add_argument('--save_dir', dest='save_dir', default=None,
+                    help='package the examples straight into train.obj and val.obj of this directory')
+parser.add_argument('--split_ratio', type=float, default=0.1, dest='split_ratio',
+                    help='split ratio between train and val, used with --save_dir')
+parser.add_argument('--split_mode', dest='split_mode', choices=SPLIT_MODES, default='random',
+                    help='random split, or a split by a stable hash of the character, used with --save_dir')
+parser.add_argument('--train_charset', dest='train_charset', default=None,
+                    help='charset file whose characters always go to train, used with --save_dir')
+parser.add_argument('--val_charset', dest='val_charset', default=None,
+                    help='charset file whose characters always go to val, used with --save_dir')
 parser.add_argument('--label', dest='label', type=int, default=0, help='label as the prefix of examples')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of rendering processes, 1 renders serially')
+parser.add_argument('--rebuild', dest='rebuild', type=int, default=0,
+                    help='render the whole charset again instead of only the chars missing from the manifest')
+parser.add_argument('--cache_dir', dest='cache_dir', default=None,
+                    help='directory of the persistent glyph raster cache, shared between runs')
+parser.add_argument('--cache_size', dest='cache_size', type=int, default=1024,
+                    help='size budget of the glyph cache in MB')
 
 args = parser.parse_args()
 
 if __name__ == "__main__":
 
-    if not os.path.exists(args.sample_dir):
-        os.mkdir(args.sample_dir)
+    out_dir = args.save_dir or args.sample_dir
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
 
     charset = load_charset(args.char_dir)
 
     if args.shuffle:
         np.random.shuffle(charset)
-    font2img(args.src_font, args.dst_font, charset, args.char_size,
-             args.canvas_size, args.x_offset, args.y_offset,
-             args.sample_dir, args.label, args.filter)
+
+    policy = SplitPolicy.from_files(args.split_ratio, args.split_mode, args.train_charset, args.val_charset)
+
+    if len(args.dst_font) == 1:
+        font2img(args.src_font, args.dst_font[0], charset, args.char_size,
+                 args.canvas_size, args.x_offset, args.y_offset,
+                 args.sample_dir, args.label, args.filter, args.num_workers,
+                 save_dir=args.save_dir, train_val_split=args.split_ratio,
+                 cache_dir=args.cache_dir, cache_bytes=args.cache_size << 20, rebuild=args.rebuild,
+                 split_policy=policy)
+    else:
+        out_dirs = [target_dir(out_dir, dst) for dst in args.dst_font]
+        for d in out_dirs:
+            if not os.path.exists(d):
+                os.mkdir(d)
+        font2img_multi(args.src_font, args.dst_font, charset, args.char_size,
+                       args.canvas_size, args.x_offset, args.y_offset,
+                       out_dirs, args.label, args.filter, args.num_workers,
+                       save_dirs=out_dirs if args.save_dir else None, train_val_split=args.split_ratio,
+                       cache_dir=args.cache_dir, cache_bytes=args.cache_size << 20, rebuild=args.rebuild,
+                       split_policy=policy)
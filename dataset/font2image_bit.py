@@ -10,6 +10,7 @@ from PIL import ImageDraw
 from PIL import ImageFont
 import json
 import collections
+from util.arraystore import ArrayExampleWriter
 
 CN_CHARSET = None
 CN_T_CHARSET = None
@@ -73,7 +74,10 @@ def filter_recurring_hash(charset, font, canvas_size, x_offset, y_offset):
 
 
 def font2img(src, dst, charset, char_size, canvas_size,
-             x_offset, y_offset, sample_dir, label=0, filter_by_hash=True):
+             x_offset, y_offset, sample_dir, label=0, filter_by_hash=True, save_dir=None, train_val_split=0.1):
+    """ Render the examples of charset into sample_dir as %d_%04d.bmp files, or if save_dir is
+    given, straight into the bit packed save_dir/train.bits and save_dir/val.bits
+    """
     src_font = ImageFont.truetype(src, size=char_size)
     dst_font = ImageFont.truetype(dst, size=char_size)
 
@@ -82,15 +86,27 @@ def font2img(src, dst, charset, char_size, canvas_size,
         filter_hashes = set(filter_recurring_hash(charset, dst_font, canvas_size, x_offset, y_offset))
         print("filter hashes -> %s" % (",".join([str(h) for h in filter_hashes])))
 
+    writer = None
+    if save_dir:
+        writer = ArrayExampleWriter(os.path.join(save_dir, "train.bits"), os.path.join(save_dir, "val.bits"),
+                                    train_val_split=train_val_split, packed=True)
+
     count = 0
 
-    for c in charset:
-        e = draw_example(c, src_font, dst_font, canvas_size, x_offset, y_offset, filter_hashes)
-        if e:
-            e.save(os.path.join(sample_dir, "%d_%04d.bmp" % (label, count)))
-            count += 1
-            if count % 100 == 0:
-                print("processed %d chars" % count)
+    try:
+        for c in charset:
+            e = draw_example(c, src_font, dst_font, canvas_size, x_offset, y_offset, filter_hashes)
+            if e:
+                if writer:
+                    writer.write(e, char=c)
+                else:
+                    e.save(os.path.join(sample_dir, "%d_%04d.bmp" % (label, count)))
+                count += 1
+                if count % 100 == 0:
+                    print("processed %d chars" % count)
+    finally:
+        if writer:
+            writer.close()
 
 
 # load_global_charset()
@@ -107,14 +123,19 @@ parser.add_argument('--canvas_size', dest='canvas_size', type=int, default=256,
 parser.add_argument('--x_offset', dest='x_offset', type=int, default=0, help='x offset')
 parser.add_argument('--y_offset', dest='y_offset', type=int, default=0, help='y_offset')
 parser.add_argument('--sample_dir', dest='sample_dir', help='directory to save examples')
+parser.add_argument('--save_dir', dest='save_dir', default=None,
+                    help='pack the examples straight into train.bits and val.bits of this directory')
+parser.add_argument('--split_ratio', type=float, default=0.1, dest='split_ratio',
+                    help='split ratio between train and val, used with --save_dir')
 parser.add_argument('--label', dest='label', type=int, default=0, help='label as the prefix of examples')
 
 args = parser.parse_args()
 
 if __name__ == "__main__":
 
-    if not os.path.exists(args.sample_dir):
-        os.mkdir(args.sample_dir)
+    out_dir = args.save_dir or args.sample_dir
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
 
     charset = load_charset(args.char_dir)
 
@@ -122,4 +143,4 @@ if __name__ == "__main__":
         np.random.shuffle(charset)
     font2img(args.src_font, args.dst_font, charset, args.char_size,
              args.canvas_size, args.x_offset, args.y_offset,
-             args.sample_dir, args.label, args.filter)
+             args.sample_dir, args.label, args.filter, args.save_dir, args.split_ratio)
@@ -5,38 +5,234 @@ from __future__ import absolute_import
 import argparse
 import glob
 import os
-import pickle
-import random
+import time
+from multiprocessing import Pool
+import numpy as np
+from PIL import Image
+from util.container import ExampleWriter, Manifest, SplitPolicy, SPLIT_MODES, RecordWriter, ShardManifest, \
+    SPLITS, shard_name, file_sha1
+from util.dedup import DuplicateFinder
+from util.arraystore import ArrayExampleWriter
 
 
-def pickle_examples(paths, train_path, val_path, train_val_split=0.1):
+def sample_label(name):
+    # samples are named <label>_<id>.jpg
+    prefix = name.split("_")[0]
+    return int(prefix) if prefix.isdigit() else 0
+
+
+def pickle_examples(items, train_path, val_path, train_val_split=0.1, split_policy=None):
+    """
+    Compile a list of (path, character) examples into indexed record files, so during
+    the training, any example can be read straight from the memory map
+    """
+    with ExampleWriter(train_path, val_path, train_val_split, split_policy=split_policy) as writer:
+        for p, ch in items:
+            name = os.path.basename(p)
+            with open(p, 'rb') as f:
+                print("img %s" % p)
+                img_bytes = f.read()
+                writer.write(img_bytes, label=sample_label(name), char=ch, source=name)
+
+
+def decode_examples(items, train_path, val_path, train_val_split=0.1, split_policy=None):
     """
-    Compile a list of examples into pickled format, so during
-    the training, all io will happen in memory
+    Decode a list of (path, character) examples once into uint8 [N, H, 2W] array stores,
+    the training memory maps them and slices the batches without decoding any jpeg
     """
-    with open(train_path, 'wb') as ft:
-        with open(val_path, 'wb') as fv:
-            for p in paths:
-                # label = int(os.path.basename(p).split("_")[0])
+    with ArrayExampleWriter(train_path, val_path, train_val_split, split_policy=split_policy) as writer:
+        for p, ch in items:
+            print("img %s" % p)
+            img = Image.open(p).convert("L")
+            writer.write(np.asarray(img), source=os.path.basename(p), char=ch)
+
+
+def pickle_manifest_examples(sample_dir, train_path, val_path, train_val_split=0.1, rebuild=False,
+                             split_policy=None, skip=None):
+    """
+    Package the examples listed in the manifest of sample_dir. The manifest next to
+    train_path remembers what is packaged already, so only new or changed examples
+    are read and appended, and removed ones are tombstoned. Existing examples keep
+    their train/val split. The sample files in skip are left out.
+    """
+    skip = skip or set()
+    samples = Manifest.for_dir(sample_dir)
+    packaged = Manifest.for_dir(os.path.dirname(train_path), load=not rebuild)
+    append = packaged.exists() and not rebuild
+    packaged.files = {"train": os.path.basename(train_path), "val": os.path.basename(val_path)}
+
+    removed = 0
+    # a changed example is written again into the split it had
+    kept_splits = dict()
+    for ch, record in list(packaged.records.items()):
+        sample = samples.records.get(ch)
+        if sample is None or sample["hash"] != record["hash"] or sample["source"] in skip:
+            if sample is not None and sample["source"] not in skip:
+                kept_splits[ch] = record.get("split")
+            packaged.remove(ch)
+            removed += 1
+
+    added = 0
+    with ExampleWriter(train_path, val_path, train_val_split, append=append, split_policy=split_policy) as writer:
+        try:
+            for ch, sample in samples.records.items():
+                if ch in packaged.records or sample["source"] in skip:
+                    continue
+                p = os.path.join(sample_dir, sample["source"])
                 with open(p, 'rb') as f:
                     print("img %s" % p)
                     img_bytes = f.read()
-                    r = random.random()
-                    if r < train_val_split:
-                        pickle.dump(img_bytes, fv)
-                    else:
-                        pickle.dump(img_bytes, ft)
+                name = sample["source"]
+                split, index = writer.write(img_bytes, label=sample_label(name), char=ch, source=name,
+                                            split=kept_splits.get(ch))
+                packaged.add(ch, img_bytes, source=sample["source"], split=split, index=index,
+                             sample_id=sample["id"])
+                added += 1
+        finally:
+            packaged.save()
+    print("added %d examples, removed %d examples" % (added, removed))
+
+
+def find_duplicates(items, split_policy, max_distance=4, verbose=True):
+    """
+    One pass over the (path, character) items with a perceptual hash index, return
+    (path, kind, name of the matching example) of every near duplicate of the same
+    character, exact duplicate of an unknown one, train/val leak and target that is
+    the source glyph
+    """
+    finder = DuplicateFinder(max_distance)
+    found = list()
+    start = time.time()
+    for p, ch in items:
+        name = os.path.basename(p)
+        match = finder.check(name, Image.open(p), split_policy.split(ch, name), char=ch)
+        if match is not None:
+            found.append((p, match[0], match[1]))
+            if verbose:
+                print("%s %s: %s" % (match[0], name, match[1]))
+    print("checked %d examples in %.2fs: %d duplicates, %d train/val leaks, %d same as source" % (
+        len(items), time.time() - start, finder.counts["duplicate"], finder.counts["leak"],
+        finder.counts["same_as_source"]))
+    return found
+
+
+def write_shard(job):
+    """
+    Write one shard, runs in a packaging worker
+    """
+    shard_path, split, items = job
+    with RecordWriter(shard_path) as writer:
+        for p, ch in items:
+            name = os.path.basename(p)
+            with open(p, 'rb') as f:
+                writer.write(f.read(), label=sample_label(name), char=ch, source=name, split=split)
+    return os.path.basename(shard_path), split, len(items), os.path.getsize(shard_path), file_sha1(shard_path)
+
+
+def sample_items(sample_dir):
+    """
+    (path, character) of every example of sample_dir, the character is only known
+    when the directory has a manifest
+    """
+    samples = Manifest.for_dir(sample_dir)
+    if samples.exists():
+        return [(os.path.join(sample_dir, r["source"]), ch) for ch, r in samples.records.items()]
+    return [(p, None) for p in sorted(glob.glob(os.path.join(sample_dir, "*.jpg")))]
+
+
+def package_shards(items, save_dir, shard_size=1000, num_workers=1, train_val_split=0.1, split_policy=None):
+    """
+    Package the examples into record file shards of at most shard_size records,
+    written by num_workers processes, and list them in shards.json with their
+    record counts and checksums
+    """
+    policy = split_policy or SplitPolicy(train_val_split)
+    # the split is decided up front, so the workers need no shared random state
+    by_split = dict((split, list()) for split in SPLITS)
+    for p, ch in items:
+        by_split[policy.split(ch, os.path.basename(p))].append((p, ch))
+    jobs = list()
+    for split in SPLITS:
+        split_items = by_split[split]
+        for i, start in enumerate(range(0, len(split_items), shard_size)):
+            jobs.append((os.path.join(save_dir, shard_name(split, i)), split, split_items[start:start + shard_size]))
+
+    old = ShardManifest.for_dir(save_dir)
+    manifest = ShardManifest.for_dir(save_dir, load=False)
+    start = time.time()
+    if num_workers > 1:
+        pool = Pool(num_workers)
+        try:
+            results = list(pool.imap(write_shard, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [write_shard(job) for job in jobs]
+    for file_name, split, count, size, sha1 in results:
+        print("shard %s: %d examples, %.1f MB" % (file_name, count, size / 1048576.0))
+        manifest.add(file_name, split, count, size, sha1)
+    manifest.save()
+
+    written = set(s["file"] for s in manifest.shards)
+    for shard in old.shards:
+        if shard["file"] not in written and os.path.exists(os.path.join(save_dir, shard["file"])):
+            os.remove(os.path.join(save_dir, shard["file"]))
+    counts = manifest.counts()
+    print("packaged train examples -> %d, val examples -> %d in %d shards, %.2fs" % (
+        counts["train"], counts["val"], len(manifest), time.time() - start))
+    return manifest
 
 
-parser = argparse.ArgumentParser(description='Compile list of images into a pickled object for training')
+parser = argparse.ArgumentParser(description='Compile list of images into indexed record files for training')
 parser.add_argument('--dir', dest='dir', required=True, help='path of examples')
-parser.add_argument('--save_dir', dest='save_dir', required=True, help='path to save pickled files')
+parser.add_argument('--save_dir', dest='save_dir', required=True, help='path to save packaged files')
 parser.add_argument('--split_ratio', type=float, default=0.1, dest='split_ratio',
                     help='split ratio between train and val')
+parser.add_argument('--rebuild', dest='rebuild', type=int, default=0,
+                    help='package every example again instead of appending to the packaged manifest')
+parser.add_argument('--decoded', dest='decoded', type=int, default=0,
+                    help='write decoded uint8 train.u8 and val.u8 array stores instead of record files')
+parser.add_argument('--split_mode', dest='split_mode', choices=SPLIT_MODES, default='random',
+                    help='random split, or a split by a stable hash of the character that repackaging reproduces')
+parser.add_argument('--train_charset', dest='train_charset', default=None,
+                    help='charset file whose characters always go to train, e.g. charset/final_train_3000.txt')
+parser.add_argument('--val_charset', dest='val_charset', default=None,
+                    help='charset file whose characters always go to val, e.g. charset/final_test_500.txt')
+parser.add_argument('--shard_size', dest='shard_size', type=int, default=0,
+                    help='package into record file shards of at most this many examples, listed in shards.json')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of processes writing shards, used with --shard_size')
+parser.add_argument('--dedup', dest='dedup', choices=('off', 'report', 'drop'), default='off',
+                    help='report or drop near duplicate examples, train/val leaks and targets equal to the source')
+parser.add_argument('--dedup_distance', dest='dedup_distance', type=int, default=4,
+                    help='largest perceptual hash distance in bits counted as a duplicate of the same character, '
+                         'examples without a character and a target equal to the source only match exactly')
 args = parser.parse_args()
 
 if __name__ == "__main__":
     train_path = os.path.join(args.save_dir, "train.obj")
     val_path = os.path.join(args.save_dir, "val.obj")
-    pickle_examples(glob.glob(os.path.join(args.dir, "*.jpg")), train_path=train_path, val_path=val_path,
-                    train_val_split=args.split_ratio)
+    policy = SplitPolicy.from_files(args.split_ratio, args.split_mode, args.train_charset, args.val_charset)
+    items = sample_items(args.dir)
+    dropped = set()
+    if args.dedup != 'off':
+        duplicates = find_duplicates(items, policy, args.dedup_distance)
+        if args.dedup == 'drop':
+            dropped = set(p for p, _, _ in duplicates)
+            items = [(p, ch) for p, ch in items if p not in dropped]
+            print("dropped %d examples" % len(dropped))
+    if args.shard_size > 0:
+        package_shards(items, args.save_dir, shard_size=args.shard_size,
+                       num_workers=args.num_workers, train_val_split=args.split_ratio, split_policy=policy)
+    elif args.decoded:
+        decode_examples(items, train_path=os.path.join(args.save_dir, "train.u8"),
+                        val_path=os.path.join(args.save_dir, "val.u8"), train_val_split=args.split_ratio,
+                        split_policy=policy)
+    elif Manifest.for_dir(args.dir).exists():
+        pickle_manifest_examples(args.dir, train_path=train_path, val_path=val_path,
+                                 train_val_split=args.split_ratio, rebuild=args.rebuild, split_policy=policy,
+                                 skip=set(os.path.basename(p) for p in dropped))
+    else:
+        pickle_examples(items, train_path=train_path, val_path=val_path,
+                        train_val_split=args.split_ratio, split_policy=policy)
@@ -5,38 +5,52 @@ from __future__ import absolute_import
 import argparse
 import glob
 import os
-import pickle
-import random
+from PIL import Image
+from util.container import ExampleWriter
+from util.arraystore import ArrayExampleWriter
 
 
 def pickle_examples(paths, train_path, val_path, train_val_split=0.1):
     """
-    Compile a list of examples into pickled format, so during
-    the training, all io will happen in memory
+    Compile a list of examples into indexed record files, so during
+    the training, any example can be read straight from the memory map
     """
-    with open(train_path, 'wb') as ft:
-        with open(val_path, 'wb') as fv:
-            for p in paths:
-                # label = int(os.path.basename(p).split("_")[0])
-                with open(p, 'rb') as f:
-                    print("img %s" % p)
-                    img_bytes = f.read()
-                    r = random.random()
-                    if r < train_val_split:
-                        pickle.dump(img_bytes, fv)
-                    else:
-                        pickle.dump(img_bytes, ft)
-
-
-parser = argparse.ArgumentParser(description='Compile list of images into a pickled object for training')
+    with ExampleWriter(train_path, val_path, train_val_split) as writer:
+        for p in paths:
+            with open(p, 'rb') as f:
+                print("img %s" % p)
+                img_bytes = f.read()
+                writer.write(img_bytes, source=os.path.basename(p))
+
+
+def pack_examples(paths, train_path, val_path, train_val_split=0.1):
+    """
+    Compile a list of 1-bit examples into bit packed stores, 8 pixels per byte,
+    which the training loads memory mapped and unpacks per batch
+    """
+    with ArrayExampleWriter(train_path, val_path, train_val_split, packed=True) as writer:
+        for p in paths:
+            print("img %s" % p)
+            img = Image.open(p)
+            writer.write(img.convert("1") if img.mode != "1" else img, source=os.path.basename(p))
+
+
+parser = argparse.ArgumentParser(description='Compile list of images into indexed record files for training')
 parser.add_argument('--dir', dest='dir', required=True, help='path of examples')
-parser.add_argument('--save_dir', dest='save_dir', required=True, help='path to save pickled files')
+parser.add_argument('--save_dir', dest='save_dir', required=True, help='path to save packaged files')
 parser.add_argument('--split_ratio', type=float, default=0.1, dest='split_ratio',
                     help='split ratio between train and val')
+parser.add_argument('--packed', dest='packed', type=int, default=0,
+                    help='write bit packed train.bits and val.bits instead of record files')
 args = parser.parse_args()
 
 if __name__ == "__main__":
-    train_path = os.path.join(args.save_dir, "train.obj")
-    val_path = os.path.join(args.save_dir, "val.obj")
-    pickle_examples(glob.glob(os.path.join(args.dir, "*.bmp")), train_path=train_path, val_path=val_path,
-                    train_val_split=args.split_ratio)
+    if args.packed:
+        pack_examples(glob.glob(os.path.join(args.dir, "*.bmp")),
+                      train_path=os.path.join(args.save_dir, "train.bits"),
+                      val_path=os.path.join(args.save_dir, "val.bits"), train_val_split=args.split_ratio)
+    else:
+        train_path = os.path.join(args.save_dir, "train.obj")
+        val_path = os.path.join(args.save_dir, "val.obj")
+        pickle_examples(glob.glob(os.path.join(args.dir, "*.bmp")), train_path=train_path, val_path=val_path,
+                        train_val_split=args.split_ratio)
@@ -12,9 +12,11 @@ from skimage.measure import compare_mse, compare_nrmse, compare_ssim, compare_ps
 from skimage.morphology import disk
 # from sklearn.neighbors.kde import KernelDensity
 from skimage.filters import threshold_otsu, rank
-from util.ops import conv2d, deconv2d, lrelu, fc, batch_norm
+from util.ops import conv2d, deconv2d, lrelu, fc, flatten, batch_norm, image_pair_input
 from util.dataset import TrainDataProvider, InjectDataProvider
+from util.tfdata import TrainPipeline, pipeline_batch
 from util.uitls import scale_back, merge, save_concat_images, save_image
+from util.scheduler import ScalarAverager
 
 # Auxiliary wrapper classes
 # Used to save handles(important nodes in computation graph) for later evaluation
@@ -28,7 +30,8 @@ SummaryHandle = namedtuple("SummaryHandle", ["d_merged", "g_merged"])
 class Font2Font(object):
     def __init__(self, experiment_dir=None, experiment_id=0, batch_size=16, input_width=256, output_width=256,
                  generator_dim=64, discriminator_dim=64, L1_penalty=100, Lconst_penalty=15, Ltv_penalty=0.0,
-                 Lcategory_penalty=1.0, input_filters=1, output_filters=1):
+                 Lcategory_penalty=1.0, input_filters=1, output_filters=1, uint8_input=False,
+                 input_pipeline=False):
         self.experiment_dir = experiment_dir
         self.experiment_id = experiment_id
         self.batch_size = batch_size
@@ -42,6 +45,12 @@ class Font2Font(object):
         self.Lcategory_penalty = Lcategory_penalty
         self.input_filters = input_filters
         self.output_filters = output_filters
+        # feed uint8 examples, normalized in the graph
+        self.uint8_input = uint8_input
+        # read the train batches by a tf.data pipeline instead of feed_dict
+        self.input_pipeline = input_pipeline
+        self.pipeline = None
+        self.pipeline_batch = None
         # init all the directories
         self.sess = None
         # experiment_dir is needed for training
@@ -97,7 +106,7 @@ class Font2Font(object):
                 s / 64), int(s / 128)
 
             def decode_layer(x, output_width, output_filters, layer, enc_layer, dropout=False, do_concat=True):
-                dec = deconv2d(tf.nn.relu(x), [self.batch_size, output_width,
+                dec = deconv2d(tf.nn.relu(x), [None, output_width,
                                                output_width, output_filters], scope="g_d%d_deconv" % layer)
                 if layer != 8:
                     # IMPORTANT: normalization for last layer
@@ -144,24 +153,29 @@ class Font2Font(object):
                                   is_training, scope="d_bn_3"))
 
             # real or fake binary loss
-            fc1 = fc(tf.reshape(h3, [self.batch_size, -1]), 1, scope="d_fc1")
+            fc1 = fc(flatten(h3), 1, scope="d_fc1")
 
             return tf.sigmoid(fc1), fc1
 
     def build_model(self, is_training=True, no_target_source=False):
-        real_data = tf.placeholder(tf.float32,
-                                   [self.batch_size, self.input_width, self.input_width,
-                                    self.input_filters + self.output_filters],
-                                   name='real_A_and_B_images')
-
-        no_target_data = tf.placeholder(tf.float32,
-                                        [self.batch_size, self.input_width, self.input_width,
-                                         self.input_filters + self.output_filters],
-                                        name='no_target_A_and_B_images')
+        self.pipeline_batch = None
+        if self.input_pipeline and is_training:
+            # the pipeline loading it is built by train() from the examples it reads
+            self.pipeline_batch = pipeline_batch(self.batch_size, self.input_width, uint8=self.uint8_input)
+        real_data, real_images = image_pair_input(None, self.input_width,
+                                                  self.input_filters + self.output_filters,
+                                                  uint8=self.uint8_input, name='real_A_and_B_images',
+                                                  default=self.pipeline_batch)
+
+        no_target_data, no_target_images = image_pair_input(None, self.input_width,
+                                                            self.input_filters + self.output_filters,
+                                                            uint8=self.uint8_input,
+                                                            name='no_target_A_and_B_images',
+                                                            default=self.pipeline_batch)
         # target images
-        real_B = real_data[:, :, :, :self.input_filters]
+        real_B = real_images[:, :, :, :self.input_filters]
         # source images
-        real_A = real_data[:, :, :, self.input_filters:self.input_filters + self.output_filters]
+        real_A = real_images[:, :, :, self.input_filters:self.input_filters + self.output_filters]
 
         fake_B, encoded_real_A = self.generator(real_A, is_training=is_training)
 
@@ -213,7 +227,7 @@ class Font2Font(object):
             # however, except L1 loss, we can compute category loss, binary loss and constant losses with those examples
             # it is useful when discriminator get saturated and d_loss drops to near zero
             # those data could be used as additional source of losses to break the saturation
-            no_target_A = no_target_data[:, :, :, self.input_filters:self.input_filters + self.output_filters]
+            no_target_A = no_target_images[:, :, :, self.input_filters:self.input_filters + self.output_filters]
             no_target_B, encoded_no_target_A = self.generator(no_target_A, is_training=is_training, reuse=True)
 
             no_target_AB = tf.concat([no_target_A, no_target_B], 3)
@@ -303,7 +317,7 @@ class Font2Font(object):
         if not os.path.exists(model_dir):
             os.makedirs(model_dir)
 
-        saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
+        return saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
 
     def restore_model(self, saver, model_dir):
 
@@ -312,8 +326,10 @@ class Font2Font(object):
         if ckpt:
             saver.restore(self.sess, ckpt.model_checkpoint_path)
             print("restored model %s" % model_dir)
+            return ckpt.model_checkpoint_path
         else:
             print("fail to restore model %s" % model_dir)
+            return None
 
     def generate_fake_samples(self, input_images):
         input_handle, loss_handle, eval_handle, summary_handle = self.retrieve_handles()
@@ -333,8 +349,8 @@ class Font2Font(object):
         fake_imgs, real_imgs, d_loss, g_loss, l1_loss = self.generate_fake_samples(images)
         print("Sample: d_loss: %.5f, g_loss: %.5f, l1_loss: %.5f" % (d_loss, g_loss, l1_loss))
 
-        merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
-        merged_real_images = merge(scale_back(real_imgs), [self.batch_size, 1])
+        merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+        merged_real_images = merge(scale_back(real_imgs), [real_imgs.shape[0], 1])
         merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
 
         model_id, _ = self.get_model_id_and_dir()
@@ -354,7 +370,7 @@ class Font2Font(object):
         gen_saver.save(self.sess, os.path.join(save_dir, model_name), global_step=0)
 
     def infer(self, source_obj, model_dir, save_dir):
-        source_provider = InjectDataProvider(source_obj)
+        source_provider = InjectDataProvider(source_obj, uint8=self.uint8_input)
 
         source_iter = source_provider.get_iter(self.batch_size)
 
@@ -371,7 +387,11 @@ class Font2Font(object):
         batch_buffer = list()
         for source_imgs in source_iter:
             fake_imgs = self.generate_fake_samples(source_imgs)[0]
-            merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
+            merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+            if batch_buffer and merged_fake_images.shape[0] != batch_buffer[0].shape[0]:
+                # the short last batch is a column of its own height, saved on its own
+                save_imgs(batch_buffer, count - 1)
+                batch_buffer = list()
             batch_buffer.append(merged_fake_images)
             if len(batch_buffer) == 10:
                 save_imgs(batch_buffer, count)
@@ -382,7 +402,9 @@ class Font2Font(object):
             save_imgs(batch_buffer, count)
 
     def train(self, lr=0.0002, epoch=100, schedule=10, resume=True,
-              freeze_encoder=False, sample_steps=1500, checkpoint_steps=15000):
+              freeze_encoder=False, sample_steps=1500, checkpoint_steps=15000,
+              prefetch=0, num_workers=1, use_processes=False, cache_bytes=0,
+              shuffle_buffer=0, summary_steps=50):
         g_vars, d_vars = self.retrieve_trainable_vars(freeze_encoder=freeze_encoder)
         input_handle, loss_handle, _, summary_handle = self.retrieve_handles()
 
@@ -400,76 +422,93 @@ class Font2Font(object):
         no_target_data = input_handle.no_target_data
 
         # filter by one type of labels
-        data_provider = TrainDataProvider(self.data_dir)
+        data_provider = TrainDataProvider(self.data_dir, prefetch=prefetch, num_workers=num_workers,
+                                          use_processes=use_processes, cache_bytes=cache_bytes,
+                                          uint8=self.uint8_input, shuffle_buffer=shuffle_buffer)
+        if self.pipeline_batch is not None:
+            # the examples the provider holds, or streams through its shuffle buffer
+            train_examples = data_provider.train if data_provider.streaming else data_provider.train.examples
+            self.pipeline = TrainPipeline(train_examples, self.batch_size, self.input_width,
+                                          uint8=self.uint8_input, batch=self.pipeline_batch)
         total_batches = data_provider.compute_total_batch_num(self.batch_size)
         val_batch_iter = data_provider.get_val(size=self.batch_size)
 
         saver = tf.train.Saver(max_to_keep=3)
         summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
+        # running means of the losses, written as summaries every summary_steps steps
+        scalars = ScalarAverager()
 
+        # the position of the run is saved with every checkpoint
+        sampler = data_provider.sampler
         if resume:
             _, model_dir = self.get_model_id_and_dir()
-            self.restore_model(saver, model_dir)
+            checkpoint_path = self.restore_model(saver, model_dir)
+            if checkpoint_path:
+                sampler.restore(checkpoint_path)
 
-        current_lr = lr
-        counter = 0
+        current_lr = lr if sampler.lr is None else sampler.lr
+        counter = sampler.step
+        start_epoch, start_batch = sampler.epoch, sampler.batch
         start_time = time.time()
 
-        for ei in range(epoch):
-            train_batch_iter = data_provider.get_train_iter(self.batch_size)
-
-
-            if (ei + 1) % schedule == 0:
+        for ei in range(start_epoch, epoch):
+            start = start_batch if ei == start_epoch else 0
+            if self.pipeline is not None and data_provider.streaming:
+                train_batch_iter = self.pipeline.batch_iter(self.sess, rng=data_provider.sampler.rng(ei),
+                                                            start=start)
+            elif self.pipeline is not None:
+                order, seeds = data_provider.train_order(self.batch_size, ei, start)
+                train_batch_iter = self.pipeline.batch_iter(self.sess, order, seeds)
+            else:
+                train_batch_iter = data_provider.get_train_iter(self.batch_size, epoch=ei, start=start)
+
+            # the learning rate of a resumed epoch is decayed already
+            if (ei + 1) % schedule == 0 and start == 0:
                 update_lr = current_lr / 2.0
                 # minimum learning rate guarantee
                 update_lr = max(update_lr, 0.0002)
                 print("decay learning rate from %.5f to %.5f" % (current_lr, update_lr))
                 current_lr = update_lr
 
-            for bid, batch in enumerate(train_batch_iter):
+            for bid, batch in enumerate(train_batch_iter, start):
                 counter += 1
                 batch_images = batch
+                # batches of the input pipeline are already in the graph
+                feed = {learning_rate: current_lr}
+                if batch_images is not None:
+                    feed.update({real_data: batch_images, no_target_data: batch_images})
                 # Optimize D
 
-                _, batch_d_loss, batch_d_loss_real, batch_d_loss_fake, d_summary = self.sess.run([d_optimizer,
+                _, batch_d_loss, batch_d_loss_real, batch_d_loss_fake = self.sess.run([d_optimizer,
                                                             loss_handle.d_loss,
                                                             loss_handle.d_loss_real,
-                                                            loss_handle.d_loss_fake,
-                                                            summary_handle.d_merged],
-                                                           feed_dict={real_data: batch_images,
-                                                                      learning_rate: current_lr,
-                                                                      no_target_data: batch_images
-                                                                      })
+                                                            loss_handle.d_loss_fake],
+                                                           feed_dict=feed)
                 # Optimize G
                 _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
-                                                feed_dict={
-                                                    real_data: batch_images,
-                                                    learning_rate: current_lr,
-                                                    no_target_data: batch_images
-                                                })
+                                                feed_dict=feed)
                 # magic move to Optimize G again
                 # according to https://github.com/carpedm20/DCGAN-tensorflow
                 # collect all the losses along the way
                 _, batch_g_loss,  \
-                const_loss, cheat_loss, l1_loss, tv_loss, g_summary = self.sess.run([g_optimizer,
+                const_loss, cheat_loss, l1_loss, tv_loss = self.sess.run([g_optimizer,
                                                                          loss_handle.g_loss,
                                                                          loss_handle.const_loss,
                                                                          loss_handle.cheat_loss,
                                                                          loss_handle.l1_loss,
-                                                                         loss_handle.tv_loss,
-                                                                         summary_handle.g_merged],
-                                                                        feed_dict={ real_data: batch_images,
-                                                                                    learning_rate: current_lr,
-                                                                                    no_target_data: batch_images
-                                                                        })
+                                                                         loss_handle.tv_loss],
+                                                                        feed_dict=feed)
+                sampler.advance(ei, bid, counter, current_lr, self.batch_size)
                 passed = time.time() - start_time
                 log_format = "Epoch: [%2d], [%4d/%4d] time: %4.4f, d_loss: %.5f, g_loss: %.5f, " + \
                              "const_loss: %.5f, cheat_loss: %.5f, l1_loss: %.5f, tv_loss: %.5f, d_loss_real: %.5f, " \
                              "d_loss_fake: %.5f"
                 print(log_format % (ei, bid, total_batches, passed, batch_d_loss, batch_g_loss,
                                     const_loss, cheat_loss, l1_loss, tv_loss, batch_d_loss_real, batch_d_loss_fake))
-                summary_writer.add_summary(d_summary, counter)
-                summary_writer.add_summary(g_summary, counter)
+                scalars.add(d_loss=batch_d_loss, g_loss=batch_g_loss, const_loss=const_loss, cheat_loss=cheat_loss,
+                            l1_loss=l1_loss, tv_loss=tv_loss)
+                if counter % summary_steps == 0:
+                    scalars.flush(summary_writer, counter)
 
                 # if counter % sample_steps == 0:
                 #     # sample the current model states with val data
@@ -477,7 +516,7 @@ class Font2Font(object):
 
                 if counter % checkpoint_steps == 0:
                     print("Checkpoint: save checkpoint step %d" % counter)
-                    self.checkpoint(saver, counter)
+                    sampler.save(self.checkpoint(saver, counter))
 
             # validation in each epoch
             self.validate_model(val_batch_iter, ei, counter)
@@ -485,14 +524,16 @@ class Font2Font(object):
             # save checkpoints in each 50 epoch
             if (ei + 1) % 50 == 0:
                 print("Checkpoint: save checkpoint epoch %d" % ei)
-                self.checkpoint(saver, counter)
+                sampler.save(self.checkpoint(saver, counter))
 
+        scalars.flush(summary_writer, counter)
         # save the last checkpoint
         print("Checkpoint: last checkpoint step %d" % counter)
-        self.checkpoint(saver, counter)
+        sampler.save(self.checkpoint(saver, counter))
+        data_provider.close()
 
     def test(self, source_provider, model_dir, save_dir):
-        source_len = len(source_provider.data.examples)
+        source_len = len(source_provider)
 
         source_len = min(16, source_len)
 
@@ -616,8 +657,8 @@ class Font2Font(object):
 
             fake_imgs_reshape = np.reshape(fake_imgs_reshape, fake_imgs.shape)
             real_imgs_reshape = np.reshape(real_imgs_reshape, real_imgs.shape)
-            merged_fake_images = merge(scale_back(fake_imgs_reshape), [source_len, 1])
-            merged_real_images = merge(scale_back(real_imgs_reshape), [source_len, 1])
+            merged_fake_images = merge(scale_back(fake_imgs_reshape), [img_shape[0], 1])
+            merged_real_images = merge(scale_back(real_imgs_reshape), [img_shape[0], 1])
             merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
             merged_pair_splited = np.split(merged_pair, 4)
             save_batch_samples(merged_pair_splited, count, threshold)
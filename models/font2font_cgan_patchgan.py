@@ -12,9 +12,11 @@ from skimage.measure import compare_mse, compare_nrmse, compare_ssim, compare_ps
 from skimage.morphology import disk
 # from sklearn.neighbors.kde import KernelDensity
 from skimage.filters import threshold_otsu, rank
-from util.ops import conv2d, deconv2d, lrelu, fc, batch_norm, tf_ssim
+from util.ops import conv2d, deconv2d, lrelu, fc, flatten, batch_norm, image_pair_input, tf_ssim, fused_train_op
 from util.dataset import TrainDataProvider, InjectDataProvider
+from util.tfdata import TrainPipeline, pipeline_batch
 from util.uitls import scale_back, merge, save_concat_images, save_image
+from util.scheduler import ScalarAverager
 
 # Auxiliary wrapper classes
 # Used to save handles(important nodes in computation graph) for later evaluation
@@ -28,12 +30,19 @@ SummaryHandle = namedtuple("SummaryHandle", ["d_merged", "g_merged"])
 class Font2Font(object):
     def __init__(self, experiment_dir=None, experiment_id=0, batch_size=16, input_width=256, output_width=256,
                  generator_dim=64, discriminator_dim=64, L1_penalty=100.0, Lconst_penalty=15.0, Ltv_penalty=0.0,
-                 Lssim_penalty=100.0, input_filters=1, output_filters=1):
+                 Lssim_penalty=100.0, input_filters=1, output_filters=1, uint8_input=False,
+                 input_pipeline=False, data_width=None):
         self.experiment_dir = experiment_dir
         self.experiment_id = experiment_id
         self.batch_size = batch_size
         self.input_width = input_width
         self.output_width = output_width
+        # the U-Net halves the width down to 1x1, one encoder and decoder layer per halving
+        self.depth = int(np.log2(output_width))
+        if 2 ** self.depth != output_width or output_width > 256 or input_width != output_width:
+            raise ValueError("input and output width must be the same power of 2 up to 256")
+        # width of the stored examples, batches are scaled down to input_width in the graph
+        self.data_width = data_width or input_width
         self.generator_dim = generator_dim
         self.discriminator_dim = discriminator_dim
         self.L1_penalty = L1_penalty
@@ -42,6 +51,12 @@ class Font2Font(object):
         self.Ltv_penalty = Ltv_penalty
         self.input_filters = input_filters
         self.output_filters = output_filters
+        # feed uint8 examples, normalized in the graph
+        self.uint8_input = uint8_input
+        # read the train batches by a tf.data pipeline instead of feed_dict
+        self.input_pipeline = input_pipeline
+        self.pipeline = None
+        self.pipeline_batch = None
         # init all the directories
         self.sess = None
         # experiment_dir is needed for training
@@ -77,27 +92,22 @@ class Font2Font(object):
 
             e1 = conv2d(images, self.generator_dim, scope="g_e1_conv")
             encode_layers["e1"] = e1
-            e2 = encode_layer(e1, self.generator_dim * 2, 2)
-            e3 = encode_layer(e2, self.generator_dim * 4, 3)
-            e4 = encode_layer(e3, self.generator_dim * 8, 4)
-            e5 = encode_layer(e4, self.generator_dim * 8, 5)
-            e6 = encode_layer(e5, self.generator_dim * 8, 6)
-            e7 = encode_layer(e6, self.generator_dim * 8, 7)
-            e8 = encode_layer(e7, self.generator_dim * 8, 8)
+            enc = e1
+            # 64, 128, 256, 512, 512, ... filters
+            for layer in range(2, self.depth + 1):
+                enc = encode_layer(enc, self.generator_dim * min(2 ** (layer - 1), 8), layer)
 
-            return e8, encode_layers
+            return enc, encode_layers
 
-    def decoder(self, encoded, encoding_layers, is_training, reuse=False):
+    def decoder(self, encoded, encoding_layers, is_training, reuse=False, dropout=True):
         with tf.variable_scope("generator"):
             if reuse:
                 tf.get_variable_scope().reuse_variables()
 
             s = self.output_width
-            s2, s4, s8, s16, s32, s64, s128 = int(s / 2), int(s / 4), int(s / 8), int(s / 16), int(s / 32), int(
-                s / 64), int(s / 128)
 
             def decode_layer(x, output_width, output_filters, layer, enc_layer, dropout=False, do_concat=True):
-                dec = deconv2d(tf.nn.relu(x), [self.batch_size, output_width,
+                dec = deconv2d(tf.nn.relu(x), [None, output_width,
                                                output_width, output_filters], scope="g_d%d_deconv" % layer)
                 if layer != 8:
                     # IMPORTANT: normalization for last layer
@@ -109,23 +119,22 @@ class Font2Font(object):
                     dec = tf.concat([dec, enc_layer], 3)
                 return dec
 
-            d1 = decode_layer(encoded, s128, self.generator_dim * 8, layer=1, enc_layer=encoding_layers["e7"],
-                              dropout=True)
-            d2 = decode_layer(d1, s64, self.generator_dim * 8, layer=2, enc_layer=encoding_layers["e6"], dropout=True)
-            d3 = decode_layer(d2, s32, self.generator_dim * 8, layer=3, enc_layer=encoding_layers["e5"], dropout=True)
-            d4 = decode_layer(d3, s16, self.generator_dim * 8, layer=4, enc_layer=encoding_layers["e4"])
-            d5 = decode_layer(d4, s8, self.generator_dim * 4, layer=5, enc_layer=encoding_layers["e3"])
-            d6 = decode_layer(d5, s4, self.generator_dim * 2, layer=6, enc_layer=encoding_layers["e2"])
-            d7 = decode_layer(d6, s2, self.generator_dim, layer=7, enc_layer=encoding_layers["e1"])
-            d8 = decode_layer(d7, s, self.output_filters, layer=8, enc_layer=None, do_concat=False)
+            # the layers are numbered as in the 256 model, d8 outputs the full width and dk is
+            # at width / 2 ** (8 - k), so the weights of a layer carry over between widths
+            dec = encoded
+            for layer in range(9 - self.depth, 8):
+                dec = decode_layer(dec, s // 2 ** (8 - layer), self.generator_dim * min(2 ** (7 - layer), 8),
+                                   layer=layer, enc_layer=encoding_layers["e%d" % (8 - layer)],
+                                   dropout=dropout and layer <= 3)
+            d8 = decode_layer(dec, s, self.output_filters, layer=8, enc_layer=None, do_concat=False)
 
             output = tf.nn.tanh(d8)  # scale to (-1, 1)
             return output
 
-    def generator(self, images, is_training, reuse=False):
-        e8, enc_layers = self.encoder(images, is_training=is_training, reuse=reuse)
-        output = self.decoder(e8, enc_layers, is_training=is_training, reuse=reuse)
-        return output, e8
+    def generator(self, images, is_training, reuse=False, dropout=True):
+        encoded, enc_layers = self.encoder(images, is_training=is_training, reuse=reuse)
+        output = self.decoder(encoded, enc_layers, is_training=is_training, reuse=reuse, dropout=dropout)
+        return output, encoded
 
     def discriminator(self, image, is_training, reuse=False):
         with tf.variable_scope("discriminator"):
@@ -144,24 +153,32 @@ class Font2Font(object):
                                   is_training, scope="d_bn_3"))
 
             # real or fake binary loss
-            fc1 = fc(tf.reshape(h3, [self.batch_size, -1]), 1, scope="d_fc1")
+            fc1 = fc(flatten(h3), 1, scope="d_fc1")
 
             return tf.sigmoid(fc1), fc1
 
     def build_model(self, is_training=True, no_target_source=False):
-        real_data = tf.placeholder(tf.float32,
-                                   [self.batch_size, self.input_width, self.input_width,
-                                    self.input_filters + self.output_filters],
-                                   name='real_A_and_B_images')
-
-        no_target_data = tf.placeholder(tf.float32,
-                                        [self.batch_size, self.input_width, self.input_width,
-                                         self.input_filters + self.output_filters],
-                                        name='no_target_A_and_B_images')
+        self.pipeline_batch = None
+        if self.input_pipeline and is_training:
+            # the pipeline loading it is built by train() from the examples it reads
+            self.pipeline_batch = pipeline_batch(self.batch_size, self.data_width, uint8=self.uint8_input)
+        real_data, real_images = image_pair_input(None, self.data_width,
+                                                  self.input_filters + self.output_filters,
+                                                  uint8=self.uint8_input, name='real_A_and_B_images',
+                                                  default=self.pipeline_batch)
+
+        no_target_data, no_target_images = image_pair_input(None, self.data_width,
+                                                            self.input_filters + self.output_filters,
+                                                            uint8=self.uint8_input,
+                                                            name='no_target_A_and_B_images',
+                                                            default=self.pipeline_batch)
+        if self.data_width != self.input_width:
+            real_images = tf.image.resize_area(real_images, [self.input_width, self.input_width])
+            no_target_images = tf.image.resize_area(no_target_images, [self.input_width, self.input_width])
         # target images
-        real_B = real_data[:, :, :, :self.input_filters]
+        real_B = real_images[:, :, :, :self.input_filters]
         # source images
-        real_A = real_data[:, :, :, self.input_filters:self.input_filters + self.output_filters]
+        real_A = real_images[:, :, :, self.input_filters:self.input_filters + self.output_filters]
 
         fake_B, encoded_real_A = self.generator(real_A, is_training=is_training)
 
@@ -186,6 +203,9 @@ class Font2Font(object):
 
         # L1 loss between real and generated images
         l1_loss = self.L1_penalty * tf.reduce_mean(tf.abs(fake_B - real_B))
+        # and of the generator in inference mode, batch norm on its moving averages and no dropout
+        val_fake_B = self.generator(real_A, is_training=False, reuse=True, dropout=False)[0]
+        val_l1_loss = self.L1_penalty * tf.reduce_mean(tf.abs(val_fake_B - real_B))
 
         # ssim loss !!
         ssim_loss =self.Lssim_penalty * (1 - tf_ssim(real_B, fake_B))
@@ -218,7 +238,7 @@ class Font2Font(object):
             # however, except L1 loss, we can compute category loss, binary loss and constant losses with those examples
             # it is useful when discriminator get saturated and d_loss drops to near zero
             # those data could be used as additional source of losses to break the saturation
-            no_target_A = no_target_data[:, :, :, self.input_filters:self.input_filters + self.output_filters]
+            no_target_A = no_target_images[:, :, :, self.input_filters:self.input_filters + self.output_filters]
             no_target_B, encoded_no_target_A = self.generator(no_target_A, is_training=is_training, reuse=True)
 
             no_target_AB = tf.concat([no_target_A, no_target_B], 3)
@@ -269,6 +289,7 @@ class Font2Font(object):
         setattr(self, "loss_handle", loss_handle)
         setattr(self, "eval_handle", eval_handle)
         setattr(self, "summary_handle", summary_handle)
+        setattr(self, "val_l1_loss", val_l1_loss)
 
     def register_session(self, sess):
         self.sess = sess
@@ -301,6 +322,8 @@ class Font2Font(object):
 
     def get_model_id_and_dir(self):
         model_id = "experiment_%d_batch_%d" % (self.experiment_id, self.batch_size)
+        if self.data_width != self.input_width:
+            model_id += "_width_%d" % self.input_width
         model_dir = os.path.join(self.checkpoint_dir, model_id)
         return model_id, model_dir
 
@@ -311,7 +334,7 @@ class Font2Font(object):
         if not os.path.exists(model_dir):
             os.makedirs(model_dir)
 
-        saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
+        return saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
 
     def restore_model(self, saver, model_dir):
 
@@ -320,8 +343,37 @@ class Font2Font(object):
         if ckpt:
             saver.restore(self.sess, ckpt.model_checkpoint_path)
             print("restored model %s" % model_dir)
+            return ckpt.model_checkpoint_path
         else:
             print("fail to restore model %s" % model_dir)
+            return None
+
+    def restore_matching(self, model_dir):
+        """
+        Restore the variables the latest checkpoint of model_dir has under the same name
+        and shape, e.g. the ones of a model of another width, the others keep their values
+        """
+        ckpt = tf.train.get_checkpoint_state(model_dir)
+        if not ckpt:
+            print("fail to restore model %s" % model_dir)
+            return
+        shapes = dict(tf.train.list_variables(ckpt.model_checkpoint_path))
+        all_vars = tf.global_variables()
+        var_list = [var for var in all_vars if shapes.get(var.op.name) == var.get_shape().as_list()]
+        tf.train.Saver(var_list=var_list).restore(self.sess, ckpt.model_checkpoint_path)
+        print("restored %d of %d variables from %s" % (len(var_list), len(all_vars), model_dir))
+
+    def evaluate_l1(self, data_provider):
+        """
+        Mean l1_loss of the generator in inference mode over the val examples, each one
+        counted once
+        """
+        input_handle = self.retrieve_handles()[0]
+        total, count = 0.0, 0
+        for images in data_provider.get_val_iter(self.batch_size, shuffle=False):
+            total += len(images) * self.sess.run(self.val_l1_loss, feed_dict={input_handle.real_data: images})
+            count += len(images)
+        return total / count
 
     def generate_fake_samples(self, input_images):
         input_handle, loss_handle, eval_handle, summary_handle = self.retrieve_handles()
@@ -342,8 +394,8 @@ class Font2Font(object):
         fake_imgs, real_imgs, d_loss, g_loss, ssim_loss, l1_loss = self.generate_fake_samples(images)
         print("Sample: d_loss: %.5f, g_loss: %.5f, ssim_loss: %.5f l1_loss: %.5f" % (d_loss, g_loss, ssim_loss, l1_loss))
 
-        merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
-        merged_real_images = merge(scale_back(real_imgs), [self.batch_size, 1])
+        merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+        merged_real_images = merge(scale_back(real_imgs), [real_imgs.shape[0], 1])
         merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
 
         model_id, _ = self.get_model_id_and_dir()
@@ -360,8 +412,8 @@ class Font2Font(object):
         print("Training set: d_loss: %.5f, g_loss: %.5f, ssim_loss: %.5f l1_loss: %.5f" % (d_loss, g_loss, ssim_loss,
                                                                                            l1_loss))
 
-        merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
-        merged_real_images = merge(scale_back(real_imgs), [self.batch_size, 1])
+        merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+        merged_real_images = merge(scale_back(real_imgs), [real_imgs.shape[0], 1])
         merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
 
         model_id, _ = self.get_model_id_and_dir()
@@ -381,7 +433,7 @@ class Font2Font(object):
         gen_saver.save(self.sess, os.path.join(save_dir, model_name), global_step=0)
 
     def infer(self, source_obj, model_dir, save_dir):
-        source_provider = InjectDataProvider(source_obj)
+        source_provider = InjectDataProvider(source_obj, uint8=self.uint8_input)
 
         source_iter = source_provider.get_iter(self.batch_size)
 
@@ -398,7 +450,11 @@ class Font2Font(object):
         batch_buffer = list()
         for source_imgs in source_iter:
             fake_imgs = self.generate_fake_samples(source_imgs)[0]
-            merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
+            merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+            if batch_buffer and merged_fake_images.shape[0] != batch_buffer[0].shape[0]:
+                # the short last batch is a column of its own height, saved on its own
+                save_imgs(batch_buffer, count - 1)
+                batch_buffer = list()
             batch_buffer.append(merged_fake_images)
             if len(batch_buffer) == 10:
                 save_imgs(batch_buffer, count)
@@ -409,7 +465,16 @@ class Font2Font(object):
             save_imgs(batch_buffer, count)
 
     def train(self, lr=0.0002, epoch=100, schedule=10, resume=True,
-              freeze_encoder=False, sample_steps=1500, checkpoint_steps=15000):
+              freeze_encoder=False, sample_steps=1500, checkpoint_steps=15000,
+              prefetch=0, num_workers=1, use_processes=False, cache_bytes=0,
+              shuffle_buffer=0, fused=False, g_updates=2, summary_steps=50, init_from=None, target_l1=0):
+        """
+        init_from is a checkpoint dir, e.g. of the model of a lower width, a run that does
+        not resume starts from its variables of matching shape. With target_l1, training stops
+        once the val l1_loss at the end of an epoch reaches it. Returns the seconds of the train
+        loop, without the data loading, restore, val l1_loss evaluations and last checkpoint, and
+        whether it reached target_l1
+        """
         g_vars, d_vars = self.retrieve_trainable_vars(freeze_encoder=freeze_encoder)
         input_handle, loss_handle, _, summary_handle = self.retrieve_handles()
 
@@ -419,85 +484,125 @@ class Font2Font(object):
         tf.set_random_seed(1234)
 
         learning_rate = tf.placeholder(tf.float32, name="learning_rate")
-        d_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.d_loss, var_list=d_vars)
-        g_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.g_loss, var_list=g_vars)
+        d_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        g_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        d_optimizer = d_adam.minimize(loss_handle.d_loss, var_list=d_vars)
+        g_optimizer = g_adam.minimize(loss_handle.g_loss, var_list=g_vars)
+        if fused:
+            # D and the first G update from one forward pass, the losses and summaries of that pass
+            fused_optimizer = fused_train_op(d_adam, loss_handle.d_loss, d_vars,
+                                             g_adam, loss_handle.g_loss, g_vars)
 
         tf.global_variables_initializer().run()
         real_data = input_handle.real_data
         no_target_data = input_handle.no_target_data
 
         # filter by one type of labels
-        data_provider = TrainDataProvider(self.data_dir)
+        data_provider = TrainDataProvider(self.data_dir, prefetch=prefetch, num_workers=num_workers,
+                                          use_processes=use_processes, cache_bytes=cache_bytes,
+                                          uint8=self.uint8_input, shuffle_buffer=shuffle_buffer)
+        if self.pipeline_batch is not None:
+            # the examples the provider holds, or streams through its shuffle buffer
+            train_examples = data_provider.train if data_provider.streaming else data_provider.train.examples
+            self.pipeline = TrainPipeline(train_examples, self.batch_size, self.data_width,
+                                          uint8=self.uint8_input, batch=self.pipeline_batch)
         total_batches = data_provider.compute_total_batch_num(self.batch_size)
         val_batch_iter = data_provider.get_val(size=self.batch_size)
         train_batch_samples = data_provider.get_train_sample(size=self.batch_size)
 
         saver = tf.train.Saver(max_to_keep=100)
         summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
+        # running means of the losses, written as summaries every summary_steps steps
+        scalars = ScalarAverager()
 
+        # the position of the run is saved with every checkpoint
+        sampler = data_provider.sampler
+        checkpoint_path = None
         if resume:
             _, model_dir = self.get_model_id_and_dir()
-            self.restore_model(saver, model_dir)
-
-        current_lr = lr
-        counter = 0
+            checkpoint_path = self.restore_model(saver, model_dir)
+            if checkpoint_path:
+                sampler.restore(checkpoint_path)
+        if not checkpoint_path and init_from:
+            self.restore_matching(init_from)
+
+        current_lr = lr if sampler.lr is None else sampler.lr
+        counter = sampler.step
+        start_epoch, start_batch = sampler.epoch, sampler.batch
         start_time = time.time()
-
-        for ei in range(epoch):
-            train_batch_iter = data_provider.get_train_iter(self.batch_size)
-
-            if (ei + 1) % schedule == 0:
+        # seconds of the target_l1 evaluations, not part of the train time
+        eval_time = 0.0
+        reached = False
+
+        for ei in range(start_epoch, epoch):
+            start = start_batch if ei == start_epoch else 0
+            if self.pipeline is not None and data_provider.streaming:
+                train_batch_iter = self.pipeline.batch_iter(self.sess, rng=data_provider.sampler.rng(ei),
+                                                            start=start)
+            elif self.pipeline is not None:
+                order, seeds = data_provider.train_order(self.batch_size, ei, start)
+                train_batch_iter = self.pipeline.batch_iter(self.sess, order, seeds)
+            else:
+                train_batch_iter = data_provider.get_train_iter(self.batch_size, epoch=ei, start=start)
+
+            # the learning rate of a resumed epoch is decayed already
+            if (ei + 1) % schedule == 0 and start == 0:
                 update_lr = current_lr / 2.0
                 # minimum learning rate guarantee
                 update_lr = max(update_lr, 0.0002)
                 print("decay learning rate from %.5f to %.5f" % (current_lr, update_lr))
                 current_lr = update_lr
 
-            for bid, batch in enumerate(train_batch_iter):
+            for bid, batch in enumerate(train_batch_iter, start):
                 counter += 1
                 batch_images = batch
-                # Optimize D
-
-                _, batch_d_loss, batch_d_loss_real, batch_d_loss_fake, d_summary = self.sess.run([d_optimizer,
-                                                            loss_handle.d_loss,
-                                                            loss_handle.d_loss_real,
-                                                            loss_handle.d_loss_fake,
-                                                            summary_handle.d_merged],
-                                                           feed_dict={real_data: batch_images,
-                                                                      learning_rate: current_lr,
-                                                                      no_target_data: batch_images
-                                                                      })
-                # Optimize G
-                _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
-                                                feed_dict={
-                                                    real_data: batch_images,
-                                                    learning_rate: current_lr,
-                                                    no_target_data: batch_images
-                                                })
-                # magic move to Optimize G again
-                # according to https://github.com/carpedm20/DCGAN-tensorflow
-                # collect all the losses along the way
-                _, batch_g_loss,  \
-                const_loss, cheat_loss, ssim_loss, l1_loss, tv_loss, g_summary = self.sess.run([g_optimizer,
-                                                                         loss_handle.g_loss,
-                                                                         loss_handle.const_loss,
-                                                                         loss_handle.cheat_loss,
-                                                                         loss_handle.ssim_loss,
-                                                                         loss_handle.l1_loss,
-                                                                         loss_handle.tv_loss,
-                                                                         summary_handle.g_merged],
-                                                                        feed_dict={ real_data: batch_images,
-                                                                                    learning_rate: current_lr,
-                                                                                    no_target_data: batch_images
-                                                                        })
+                # batches of the input pipeline are already in the graph
+                feed = {learning_rate: current_lr}
+                if batch_images is not None:
+                    feed.update({real_data: batch_images, no_target_data: batch_images})
+                if fused:
+                    _, batch_d_loss, batch_d_loss_real, batch_d_loss_fake, batch_g_loss, const_loss, \
+                    cheat_loss, ssim_loss, l1_loss, tv_loss = self.sess.run(
+                        [fused_optimizer, loss_handle.d_loss, loss_handle.d_loss_real, loss_handle.d_loss_fake, loss_handle.g_loss, loss_handle.const_loss,
+                         loss_handle.cheat_loss, loss_handle.ssim_loss, loss_handle.l1_loss,
+                         loss_handle.tv_loss],
+                        feed_dict=feed)
+                    for _ in range(g_updates - 1):
+                        self.sess.run(g_optimizer, feed_dict=feed)
+                else:
+                    # Optimize D
+
+                    _, batch_d_loss, batch_d_loss_real, batch_d_loss_fake = self.sess.run([d_optimizer,
+                                                                loss_handle.d_loss,
+                                                                loss_handle.d_loss_real,
+                                                                loss_handle.d_loss_fake],
+                                                               feed_dict=feed)
+                    # Optimize G
+                    _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
+                                                    feed_dict=feed)
+                    # magic move to Optimize G again
+                    # according to https://github.com/carpedm20/DCGAN-tensorflow
+                    # collect all the losses along the way
+                    _, batch_g_loss,  \
+                    const_loss, cheat_loss, ssim_loss, l1_loss, tv_loss = self.sess.run([g_optimizer,
+                                                                             loss_handle.g_loss,
+                                                                             loss_handle.const_loss,
+                                                                             loss_handle.cheat_loss,
+                                                                             loss_handle.ssim_loss,
+                                                                             loss_handle.l1_loss,
+                                                                             loss_handle.tv_loss],
+                                                                            feed_dict=feed)
+                sampler.advance(ei, bid, counter, current_lr, self.batch_size)
                 passed = time.time() - start_time
                 log_format = "Epoch: [%2d], [%4d/%4d] time: %4.4f, d_loss: %.5f, g_loss: %.5f, " + \
                              "const_loss: %.5f, cheat_loss: %.5f, ssim_loss: %.5f, l1_loss: %.5f,tv_loss: %.5f, " \
                              "d_loss_real: %.5f, d_loss_fake: %.5f"
                 print(log_format % (ei, bid, total_batches, passed, batch_d_loss, batch_g_loss, const_loss, cheat_loss,
                                     ssim_loss, l1_loss,tv_loss, batch_d_loss_real, batch_d_loss_fake))
-                summary_writer.add_summary(d_summary, counter)
-                summary_writer.add_summary(g_summary, counter)
+                scalars.add(d_loss=batch_d_loss, g_loss=batch_g_loss, const_loss=const_loss, cheat_loss=cheat_loss,
+                            ssim_loss=ssim_loss, l1_loss=l1_loss, tv_loss=tv_loss)
+                if counter % summary_steps == 0:
+                    scalars.flush(summary_writer, counter)
 
                 # if counter % sample_steps == 0:
                 #     # sample the current model states with val data
@@ -516,14 +621,29 @@ class Font2Font(object):
                 self.validate_model(val_batch_iter, ei, counter)
                 self.validate_train_model(train_batch_samples, ei, counter)
                 print("Checkpoint: save checkpoint epoch %d" % ei)
-                self.checkpoint(saver, counter)
-
+                sampler.save(self.checkpoint(saver, counter))
+
+            if target_l1 > 0:
+                eval_start = time.time()
+                val_l1 = self.evaluate_l1(data_provider)
+                eval_time += time.time() - eval_start
+                print("Val: l1_loss: %.5f, target: %.5f" % (val_l1, target_l1))
+                if val_l1 <= target_l1:
+                    reached = True
+                    print("Target: l1_loss %.5f reached in %.1f sec, step %d" % (
+                        target_l1, time.time() - start_time - eval_time, counter))
+                    break
+
+        train_time = time.time() - start_time - eval_time
+        scalars.flush(summary_writer, counter)
         # save the last checkpoint
         print("Checkpoint: last checkpoint step %d" % counter)
-        self.checkpoint(saver, counter)
+        sampler.save(self.checkpoint(saver, counter))
+        data_provider.close()
+        return train_time, reached
 
     def test(self, source_provider, model_dir, save_dir):
-        source_len = len(source_provider.data.examples)
+        source_len = len(source_provider)
 
         source_len = min(16, source_len)
 
@@ -647,8 +767,8 @@ class Font2Font(object):
 
             fake_imgs_reshape = np.reshape(fake_imgs_reshape, fake_imgs.shape)
             real_imgs_reshape = np.reshape(real_imgs_reshape, real_imgs.shape)
-            merged_fake_images = merge(scale_back(fake_imgs_reshape), [source_len, 1])
-            merged_real_images = merge(scale_back(real_imgs_reshape), [source_len, 1])
+            merged_fake_images = merge(scale_back(fake_imgs_reshape), [img_shape[0], 1])
+            merged_real_images = merge(scale_back(real_imgs_reshape), [img_shape[0], 1])
             merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
             merged_pair_splited = np.split(merged_pair, 4)
             save_batch_samples(merged_pair_splited, count, threshold)
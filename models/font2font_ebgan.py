@@ -8,9 +8,10 @@ import scipy.misc as misc
 import os
 import time
 from collections import namedtuple
-from util.ops import conv2d, deconv2d, lrelu, fc, batch_norm
+from util.ops import conv2d, deconv2d, lrelu, fc, batch_norm, fused_train_op
 from util.dataset import TrainDataProvider, InjectDataProvider
 from util.uitls import scale_back, merge, save_concat_images
+from util.scheduler import ScalarAverager, checkpoint_step
 
 # Auxiliary wrapper classes
 # Used to save handles(important nodes in computation graph) for later evaluation
@@ -23,7 +24,10 @@ SummaryHandle = namedtuple("SummaryHandle", ["d_merged", "g_merged"])
 class Font2Font(object):
     def __init__(self, experiment_dir=None, experiment_id=0, batch_size=16, input_width=256, output_width=256,
                  generator_dim=64, discriminator_dim=64, L1_penalty=100, Lconst_penalty=15, Ltv_penalty=0.0,
-                 Lcategory_penalty=1.0, input_filters=1, output_filters=1):
+                 Lcategory_penalty=1.0, input_filters=1, output_filters=1, input_pipeline=False):
+        if input_pipeline:
+            raise ValueError("this model is trained by feed_dict only, the tf.data input pipeline is supported "
+                             "by the cgan_patchgan, cgan_simple, cgan_bitmap, ave and wgan models")
         self.experiment_dir = experiment_dir
         self.experiment_id = experiment_id
         self.batch_size = batch_size
@@ -92,7 +96,7 @@ class Font2Font(object):
                 s / 64), int(s / 128)
 
             def decode_layer(x, output_width, output_filters, layer, enc_layer, dropout=False, do_concat=True):
-                dec = deconv2d(tf.nn.relu(x), [self.batch_size, output_width,
+                dec = deconv2d(tf.nn.relu(x), [None, output_width,
                                                output_width, output_filters], scope="g_d%d_deconv" % layer)
                 if layer != 8:
                     # IMPORTANT: normalization for last layer
@@ -148,7 +152,7 @@ class Font2Font(object):
                 s / 64), int(s / 128)
 
             def decode_layer(x, output_width, output_filters, layer, dropout=False):
-                dec = deconv2d(tf.nn.relu(x), [self.batch_size, output_width, output_width, output_filters],
+                dec = deconv2d(tf.nn.relu(x), [None, output_width, output_width, output_filters],
                                scope="d_d%d_deconv" % layer)
                 if layer != 8:
                     dec = batch_norm(dec, is_training, scope="d_d%d_bn" %layer)
@@ -170,12 +174,12 @@ class Font2Font(object):
 
     def build_model(self, is_training=True, no_target_source=False):
         real_data = tf.placeholder(tf.float32,
-                                   [self.batch_size, self.input_width, self.input_width,
+                                   [None, self.input_width, self.input_width,
                                     self.input_filters + self.output_filters],
                                    name='real_A_and_B_images')
 
         no_target_data = tf.placeholder(tf.float32,
-                                        [self.batch_size, self.input_width, self.input_width,
+                                        [None, self.input_width, self.input_width,
                                          self.input_filters + self.output_filters],
                                         name='no_target_A_and_B_images')
         # target images
@@ -306,7 +310,7 @@ class Font2Font(object):
         if not os.path.exists(model_dir):
             os.makedirs(model_dir)
 
-        saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
+        return saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
 
     def restore_model(self, saver, model_dir):
 
@@ -315,8 +319,10 @@ class Font2Font(object):
         if ckpt:
             saver.restore(self.sess, ckpt.model_checkpoint_path)
             print("restored model %s" % model_dir)
+            return ckpt.model_checkpoint_path
         else:
             print("fail to restore model %s" % model_dir)
+            return None
 
     def generate_fake_samples(self, input_images):
         input_handle, loss_handle, eval_handle, summary_handle = self.retrieve_handles()
@@ -336,8 +342,8 @@ class Font2Font(object):
         fake_imgs, real_imgs, d_loss, g_loss, l1_loss = self.generate_fake_samples(images)
         print("Sample: d_loss: %.5f, g_loss: %.5f, l1_loss: %.5f" % (d_loss, g_loss, l1_loss))
 
-        merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
-        merged_real_images = merge(scale_back(real_imgs), [self.batch_size, 1])
+        merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+        merged_real_images = merge(scale_back(real_imgs), [real_imgs.shape[0], 1])
         merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
 
         model_id, _ = self.get_model_id_and_dir()
@@ -462,7 +468,11 @@ class Font2Font(object):
         batch_buffer = list()
         for source_imgs in source_iter:
             fake_imgs = self.generate_fake_samples(source_imgs)[0]
-            merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
+            merged_fake_images = merge(scale_back(fake_imgs), [fake_imgs.shape[0], 1])
+            if batch_buffer and merged_fake_images.shape[0] != batch_buffer[0].shape[0]:
+                # the short last batch is a column of its own height, saved on its own
+                save_imgs(batch_buffer, count - 1)
+                batch_buffer = list()
             batch_buffer.append(merged_fake_images)
             if len(batch_buffer) == 10:
                 save_imgs(batch_buffer, count)
@@ -473,7 +483,7 @@ class Font2Font(object):
             save_imgs(batch_buffer, count)
 
     def train(self, lr=0.0002, epoch=100, schedule=10, resume=True,
-              freeze_encoder=False, sample_steps=50, checkpoint_steps=500):
+              freeze_encoder=False, sample_steps=50, checkpoint_steps=500, fused=False, g_updates=2, summary_steps=50):
         g_vars, d_vars = self.retrieve_trainable_vars(freeze_encoder=freeze_encoder)
         input_handle, loss_handle, _, summary_handle = self.retrieve_handles()
 
@@ -483,8 +493,14 @@ class Font2Font(object):
         tf.set_random_seed(1234)
 
         learning_rate = tf.placeholder(tf.float32, name="learning_rate")
-        d_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.d_loss, var_list=d_vars)
-        g_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.g_loss, var_list=g_vars)
+        d_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        g_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        d_optimizer = d_adam.minimize(loss_handle.d_loss, var_list=d_vars)
+        g_optimizer = g_adam.minimize(loss_handle.g_loss, var_list=g_vars)
+        if fused:
+            # D and the first G update from one forward pass, the losses and summaries of that pass
+            fused_optimizer = fused_train_op(d_adam, loss_handle.d_loss, d_vars,
+                                             g_adam, loss_handle.g_loss, g_vars)
 
         tf.global_variables_initializer().run()
         real_data = input_handle.real_data
@@ -497,88 +513,109 @@ class Font2Font(object):
 
         saver = tf.train.Saver(max_to_keep=3)
         summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
+        # running means of the losses, written as summaries every summary_steps steps
+        scalars = ScalarAverager()
 
+        # the position of the run is saved with every checkpoint
+        sampler = data_provider.sampler
         if resume:
             _, model_dir = self.get_model_id_and_dir()
-            self.restore_model(saver, model_dir)
-
-        current_lr = lr
-        counter = 0
+            checkpoint_path = self.restore_model(saver, model_dir)
+            if checkpoint_path and not sampler.restore(checkpoint_path):
+                # without a saved position go on from the restored global step at least,
+                # new checkpoints do not reuse its names
+                sampler.step = checkpoint_step(checkpoint_path)
+
+        current_lr = lr if sampler.lr is None else sampler.lr
+        counter = sampler.step
+        start_epoch, start_batch = sampler.epoch, sampler.batch
         start_time = time.time()
 
-        for ei in range(epoch):
-            train_batch_iter = data_provider.get_train_iter(self.batch_size)
+        for ei in range(start_epoch, epoch):
+            start = start_batch if ei == start_epoch else 0
+            train_batch_iter = data_provider.get_train_iter(self.batch_size, epoch=ei, start=start)
 
-            if (ei + 1) % schedule == 0:
+            # the learning rate of a resumed epoch is decayed already
+            if (ei + 1) % schedule == 0 and start == 0:
                 update_lr = current_lr / 2.0
                 # minimum learning rate guarantee
                 update_lr = max(update_lr, 0.0002)
                 print("decay learning rate from %.5f to %.5f" % (current_lr, update_lr))
                 current_lr = update_lr
 
-            for bid, batch in enumerate(train_batch_iter):
+            for bid, batch in enumerate(train_batch_iter, start):
                 counter += 1
                 batch_images = batch
-                # Optimize D
-
-                # _, batch_d_loss, d_summary = self.sess.run([d_optimizer, loss_handle.d_loss,
-                #                                             summary_handle.d_merged],
-                #                                            feed_dict={real_data: batch_images,
-                #                                                       learning_rate: current_lr,
-                #                                                       no_target_data: batch_images
-                #                                                       })
-                # # Optimize G
-                # _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
-                #                                 feed_dict={
-                #                                     real_data: batch_images,
-                #                                     learning_rate: current_lr,
-                #                                     no_target_data: batch_images
-                #                                 })
-
-                _, batch_d_loss, d_summary = self.sess.run([d_optimizer, loss_handle.d_loss,
-                                                            summary_handle.d_merged],
-                                                           feed_dict={real_data: batch_images,
-                                                                      learning_rate: current_lr
-                                                                      })
-                # Optimize G
-                _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
-                                                feed_dict={
-                                                    real_data: batch_images,
-                                                    learning_rate: current_lr
-                                                })
-                # magic move to Optimize G again
-                # according to https://github.com/carpedm20/DCGAN-tensorflow
-                # collect all the losses along the way
-                # _, batch_g_loss,  \
-                # const_loss,  l1_loss, tv_loss, g_summary = self.sess.run([g_optimizer,
-                #                                                          loss_handle.g_loss,
-                #                                                          loss_handle.const_loss,
-                #
-                #                                                          loss_handle.l1_loss,
-                #                                                          loss_handle.tv_loss,
-                #                                                          summary_handle.g_merged],
-                #                                                         feed_dict={ real_data: batch_images,
-                #                                                                     learning_rate: current_lr,
-                #                                                                     no_target_data: batch_images
-                #                                                         })
-                _, batch_g_loss, \
-                const_loss, l1_loss, tv_loss, g_summary = self.sess.run([g_optimizer,
-                                                                         loss_handle.g_loss,
-                                                                         loss_handle.const_loss,
-
-                                                                         loss_handle.l1_loss,
-                                                                         loss_handle.tv_loss,
-                                                                         summary_handle.g_merged],
-                                                                        feed_dict={real_data: batch_images,
-                                                                                   learning_rate: current_lr
-                                                                                   })
+                if fused:
+                    feed = {real_data: batch_images, learning_rate: current_lr}
+                    _, batch_d_loss, batch_g_loss, const_loss, l1_loss, tv_loss = self.sess.run(
+                        [fused_optimizer, loss_handle.d_loss, loss_handle.g_loss,
+                         loss_handle.const_loss, loss_handle.l1_loss, loss_handle.tv_loss],
+                        feed_dict=feed)
+                    for _ in range(g_updates - 1):
+                        self.sess.run(g_optimizer, feed_dict=feed)
+                else:
+                    # Optimize D
+
+                    # _, batch_d_loss, d_summary = self.sess.run([d_optimizer, loss_handle.d_loss,
+                    #                                             summary_handle.d_merged],
+                    #                                            feed_dict={real_data: batch_images,
+                    #                                                       learning_rate: current_lr,
+                    #                                                       no_target_data: batch_images
+                    #                                                       })
+                    # # Optimize G
+                    # _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
+                    #                                 feed_dict={
+                    #                                     real_data: batch_images,
+                    #                                     learning_rate: current_lr,
+                    #                                     no_target_data: batch_images
+                    #                                 })
+
+                    _, batch_d_loss = self.sess.run([d_optimizer, loss_handle.d_loss],
+                                                               feed_dict={real_data: batch_images,
+                                                                          learning_rate: current_lr
+                                                                          })
+                    # Optimize G
+                    _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
+                                                    feed_dict={
+                                                        real_data: batch_images,
+                                                        learning_rate: current_lr
+                                                    })
+                    # magic move to Optimize G again
+                    # according to https://github.com/carpedm20/DCGAN-tensorflow
+                    # collect all the losses along the way
+                    # _, batch_g_loss,  \
+                    # const_loss,  l1_loss, tv_loss, g_summary = self.sess.run([g_optimizer,
+                    #                                                          loss_handle.g_loss,
+                    #                                                          loss_handle.const_loss,
+                    #
+                    #                                                          loss_handle.l1_loss,
+                    #                                                          loss_handle.tv_loss,
+                    #                                                          summary_handle.g_merged],
+                    #                                                         feed_dict={ real_data: batch_images,
+                    #                                                                     learning_rate: current_lr,
+                    #                                                                     no_target_data: batch_images
+                    #                                                         })
+                    _, batch_g_loss, \
+                    const_loss, l1_loss, tv_loss = self.sess.run([g_optimizer,
+                                                                             loss_handle.g_loss,
+                                                                             loss_handle.const_loss,
+
+                                                                             loss_handle.l1_loss,
+                                                                             loss_handle.tv_loss],
+                                                                            feed_dict={real_data: batch_images,
+                                                                                       learning_rate: current_lr
+                                                                                       })
+                sampler.advance(ei, bid, counter, current_lr, self.batch_size)
                 passed = time.time() - start_time
                 log_format = "Epoch: [%2d], [%4d/%4d] time: %4.4f, d_loss: %.5f, g_loss: %.5f, " + \
                              "const_loss: %.5f, l1_loss: %.5f, tv_loss: %.5f"
                 print(log_format % (ei, bid, total_batches, passed, batch_d_loss, batch_g_loss,
                                     const_loss, l1_loss, tv_loss))
-                summary_writer.add_summary(d_summary, counter)
-                summary_writer.add_summary(g_summary, counter)
+                scalars.add(d_loss=batch_d_loss, g_loss=batch_g_loss, const_loss=const_loss, l1_loss=l1_loss,
+                            tv_loss=tv_loss)
+                if counter % summary_steps == 0:
+                    scalars.flush(summary_writer, counter)
 
                 if counter % sample_steps == 0:
                     # sample the current model states with val data
@@ -586,7 +623,7 @@ class Font2Font(object):
 
                 if counter % checkpoint_steps == 0:
                     print("Checkpoint: save checkpoint step %d" % counter)
-                    self.checkpoint(saver, counter)
+                    sampler.save(self.checkpoint(saver, counter))
 
         # valiation the models
         # print("val.examples len:{}".format(len(data_provider.val.examples)))
@@ -599,12 +636,13 @@ class Font2Font(object):
         # accuracy /= iters
         # print("Avg accuracy: %.5f" % accuracy)
 
+        scalars.flush(summary_writer, counter)
         # save the last checkpoint
         print("Checkpoint: last checkpoint step %d" % counter)
-        self.checkpoint(saver, counter)
+        sampler.save(self.checkpoint(saver, counter))
 
     def test(self, source_provider, model_dir, save_dir):
-        source_len = len(source_provider.data.examples)
+        source_len = len(source_provider)
 
         source_iter = source_provider.get_iter(source_len)
 
@@ -658,8 +696,8 @@ class Font2Font(object):
 
             fake_imgs_reshape = np.reshape(fake_imgs_reshape, fake_imgs.shape)
             real_imgs_reshape = np.reshape(real_imgs_reshape, real_imgs.shape)
-            merged_fake_images = merge(scale_back(fake_imgs_reshape), [source_len, 1])
-            merged_real_images = merge(scale_back(real_imgs_reshape), [source_len, 1])
+            merged_fake_images = merge(scale_back(fake_imgs_reshape), [img_shape[0], 1])
+            merged_real_images = merge(scale_back(real_imgs_reshape), [img_shape[0], 1])
             merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
 
             batch_buffer.append(merged_pair)
@@ -25,10 +25,8 @@ def main(_):
 
     with tf.Session(config=config) as sess:
         source_provider = InjectDataProvider(args.source_obj)
-        source_len = len(source_provider.data.examples)
-        source_len = min(10, source_len)
 
-        model = Font2Font(batch_size=source_len)
+        model = Font2Font(batch_size=args.batch_size)
         model.register_session(sess)
         model.build_model(is_training=False)
 
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from util.container import RecordFile, RecordWriter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# appends to the record file of argv[1] and is killed before close()
+KILLED_APPEND = """
+import os, signal, sys
+sys.path.insert(0, %r)
+from util.container import RecordWriter
+writer = RecordWriter(sys.argv[1], append=True)
+for i in range(3):
+    writer.write(b"appended" * 100, label=1, char=u"x", source="x_%%d.jpg" %% i, split="train")
+writer.f.flush()
+os.kill(os.getpid(), signal.SIGKILL)
+""" % ROOT
+
+
+class RecordFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "train.obj")
+        with RecordWriter(self.path) as writer:
+            writer.write(b"first", label=0, char=u"一", source="0_0.jpg", split="train")
+            writer.write(b"second", label=0, char=u"二", source="0_1.jpg", split="train")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_killed_append_leaves_the_file_as_it_was(self):
+        size = os.path.getsize(self.path)
+        result = subprocess.call([sys.executable, "-c", KILLED_APPEND, self.path])
+        self.assertNotEqual(result, 0)
+        self.assertGreater(os.path.getsize(self.path), size)
+
+        with RecordFile(self.path) as records:
+            self.assertEqual(len(records), 2)
+            self.assertEqual(records.read(1, verify=True), b"second")
+            self.assertEqual(records.info(0)["char"], u"一")
+            self.assertEqual(records.validate(), [])
+
+        with RecordWriter(self.path, append=True) as writer:
+            writer.write(b"third", label=0, char=u"三", source="0_2.jpg", split="train")
+        with RecordFile(self.path) as records:
+            self.assertEqual(len(records), 3)
+            self.assertEqual(records.get(u"三", verify=True), b"third")
+            self.assertEqual(records.get(u"一", verify=True), b"first")
+
+    def test_append_to_legacy_pickle_names_the_fix(self):
+        legacy_path = os.path.join(self.dir, "val.obj")
+        with open(legacy_path, "wb") as f:
+            pickle.dump((0, b"legacy"), f)
+        with self.assertRaisesRegex(ValueError, "rebuild"):
+            RecordWriter(legacy_path, append=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
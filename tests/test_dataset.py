@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    from util.arraystore import ArrayStoreWriter
+    from util.dataset import EpochSampler, InjectDataProvider, TrainDataProvider, get_batch_iter
+except ImportError as e:
+    # util.dataset reads images by scipy and imageio
+    raise unittest.SkipTest("util.dataset is not importable: %s" % e)
+
+NUM_EXAMPLES = 10
+BATCH_SIZE = 4
+
+
+def write_store(path, values):
+    """
+    Decoded [8, 16] examples, all pixels of example i are values[i]
+    """
+    with ArrayStoreWriter(path) as writer:
+        for v in values:
+            writer.write(np.full((8, 16), v, dtype=np.uint8))
+
+
+def example_values(batch):
+    return [int(e[0, 0]) for e in batch]
+
+
+class EpochSamplerTest(unittest.TestCase):
+
+    def test_resumed_epoch_is_a_slice_of_the_epoch(self):
+        sampler = EpochSampler(NUM_EXAMPLES, seed=7)
+        order, seeds = sampler.order(3, BATCH_SIZE)
+        self.assertEqual(len(order), 12)
+        self.assertEqual(sorted(set(order)), list(range(NUM_EXAMPLES)))
+        self.assertEqual(len(seeds), 3)
+        for start in range(3):
+            resumed_order, resumed_seeds = sampler.order(3, BATCH_SIZE, start)
+            np.testing.assert_array_equal(resumed_order, order[start * BATCH_SIZE:])
+            np.testing.assert_array_equal(resumed_seeds, seeds[start:])
+
+    def test_every_epoch_has_its_own_order(self):
+        sampler = EpochSampler(NUM_EXAMPLES, seed=7)
+        np.testing.assert_array_equal(sampler.order(1, BATCH_SIZE)[0], sampler.order(1, BATCH_SIZE)[0])
+        self.assertFalse(np.array_equal(sampler.order(1, BATCH_SIZE)[0], sampler.order(2, BATCH_SIZE)[0]))
+        np.testing.assert_array_equal(EpochSampler(NUM_EXAMPLES, seed=7).order(2, BATCH_SIZE)[0],
+                                      sampler.order(2, BATCH_SIZE)[0])
+
+    def test_advance_moves_to_the_next_epoch_after_the_last_batch(self):
+        sampler = EpochSampler(NUM_EXAMPLES, seed=7)
+        sampler.advance(0, 1, 2, 0.001, BATCH_SIZE)
+        self.assertEqual((sampler.epoch, sampler.batch, sampler.step), (0, 2, 2))
+        sampler.advance(0, 2, 3, 0.001, BATCH_SIZE)
+        self.assertEqual((sampler.epoch, sampler.batch, sampler.step), (1, 0, 3))
+
+    def test_restore_continues_at_the_saved_position(self):
+        model_dir = tempfile.mkdtemp()
+        try:
+            sampler = EpochSampler(NUM_EXAMPLES, seed=7)
+            sampler.advance(4, 0, 13, 0.0005, BATCH_SIZE)
+            sampler.save(os.path.join(model_dir, "font2font.model-13"))
+
+            restored = EpochSampler(NUM_EXAMPLES)
+            self.assertTrue(restored.restore(os.path.join(model_dir, "font2font.model-13")))
+            self.assertEqual((restored.seed, restored.epoch, restored.batch, restored.step, restored.lr),
+                             (7, 4, 1, 13, 0.0005))
+            np.testing.assert_array_equal(restored.order(4, BATCH_SIZE, 1)[0], sampler.order(4, BATCH_SIZE, 1)[0])
+
+            self.assertFalse(EpochSampler(NUM_EXAMPLES).restore(os.path.join(model_dir, "font2font.model-9")))
+        finally:
+            shutil.rmtree(model_dir)
+
+
+class UnpaddedIterationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.values = [10 * i for i in range(NUM_EXAMPLES)]
+        write_store(os.path.join(self.dir, "train.u8"), self.values)
+        write_store(os.path.join(self.dir, "val.u8"), self.values)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_val_batches_hold_every_example_once(self):
+        provider = TrainDataProvider(self.dir, uint8=True)
+        batches = list(provider.get_val_iter(BATCH_SIZE, shuffle=False))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertEqual([v for b in batches for v in example_values(b)], self.values)
+
+    def test_inject_batches_end_short(self):
+        provider = InjectDataProvider(os.path.join(self.dir, "val.u8"), uint8=True)
+        batches = list(provider.get_iter(BATCH_SIZE))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertEqual([v for b in batches for v in example_values(b)], self.values)
+
+    def test_batch_iter_pads_only_without_an_order(self):
+        examples = [np.full((8, 16), v, dtype=np.uint8) for v in self.values]
+        padded = list(get_batch_iter(examples, BATCH_SIZE, augment=False, uint8=True))
+        self.assertEqual([len(b) for b in padded], [4, 4, 4])
+        unpadded = list(get_batch_iter(examples, BATCH_SIZE, augment=False, uint8=True,
+                                       order=np.arange(len(examples))))
+        self.assertEqual([len(b) for b in unpadded], [4, 4, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import unittest
+
+from PIL import Image, ImageDraw
+
+from util.dedup import DuplicateFinder, hamming, pair_hashes
+
+# strokes of look-alike characters, (x0, y0, x1, y1) in unit coordinates
+GLYPHS = {
+    u"干": [(0.2, 0.25, 0.8, 0.25), (0.1, 0.55, 0.9, 0.55), (0.5, 0.25, 0.5, 0.9)],
+    u"千": [(0.54, 0.17, 0.46, 0.2), (0.2, 0.25, 0.8, 0.25), (0.1, 0.55, 0.9, 0.55), (0.5, 0.2, 0.5, 0.9)],
+    u"未": [(0.2, 0.3, 0.8, 0.3), (0.1, 0.5, 0.9, 0.5), (0.5, 0.1, 0.5, 0.9),
+           (0.5, 0.5, 0.15, 0.85), (0.5, 0.5, 0.85, 0.85)],
+    u"末": [(0.1, 0.3, 0.9, 0.3), (0.2, 0.5, 0.8, 0.5), (0.5, 0.1, 0.5, 0.9),
+           (0.5, 0.5, 0.15, 0.85), (0.5, 0.5, 0.85, 0.85)],
+}
+LOOK_ALIKES = [(u"干", u"千"), (u"未", u"末")]
+
+
+def draw(strokes, size, width, margin):
+    img = Image.new("L", (size, size), 255)
+    d = ImageDraw.Draw(img)
+    span = size - 2 * margin
+    for x0, y0, x1, y1 in strokes:
+        d.line([margin + x0 * span, margin + y0 * span, margin + x1 * span, margin + y1 * span],
+               fill=0, width=width)
+    return img
+
+
+def example(ch, size=128):
+    """
+    Target | source pair of ch, a bold target and a thin, smaller source glyph
+    """
+    pair = Image.new("L", (2 * size, size), 255)
+    pair.paste(draw(GLYPHS[ch], size, 12, 8), (0, 0))
+    pair.paste(draw(GLYPHS[ch], size, 5, 20), (size, 0))
+    return pair
+
+
+def pair_distance(a, b):
+    ha, hb = pair_hashes(a), pair_hashes(b)
+    return hamming(ha[0], hb[0]) + hamming(ha[1], hb[1])
+
+
+class DuplicateFinderTest(unittest.TestCase):
+
+    def test_look_alikes_are_within_the_default_distance(self):
+        for a, b in LOOK_ALIKES:
+            self.assertLessEqual(pair_distance(example(a), example(b)), 4)
+
+    def test_look_alike_characters_are_not_flagged(self):
+        finder = DuplicateFinder()
+        for a, b in LOOK_ALIKES:
+            self.assertIsNone(finder.check(a + ".jpg", example(a), "train", char=a))
+            self.assertIsNone(finder.check(b + ".jpg", example(b), "val", char=b))
+        self.assertEqual(finder.counts, {"duplicate": 0, "leak": 0, "same_as_source": 0})
+
+    def test_look_alikes_of_unknown_characters_are_not_flagged(self):
+        finder = DuplicateFinder()
+        for a, b in LOOK_ALIKES:
+            self.assertIsNone(finder.check(a + ".jpg", example(a), "train"))
+            self.assertIsNone(finder.check(b + ".jpg", example(b), "train"))
+
+    def test_copies_are_flagged(self):
+        finder = DuplicateFinder()
+        self.assertIsNone(finder.check("0.jpg", example(u"干"), "train", char=u"干"))
+        self.assertEqual(finder.check("1.jpg", example(u"干"), "val", char=u"干"), ("leak", "0.jpg"))
+        self.assertIsNone(finder.check("2.jpg", example(u"未"), "train"))
+        self.assertEqual(finder.check("3.jpg", example(u"未"), "train"), ("duplicate", "2.jpg"))
+
+    def test_target_equal_to_source(self):
+        glyph = draw(GLYPHS[u"干"], 128, 8, 12)
+        pair = Image.new("L", (256, 128), 255)
+        pair.paste(glyph, (0, 0))
+        pair.paste(glyph, (128, 0))
+        self.assertEqual(DuplicateFinder().check("0.jpg", pair, "train", char=u"干"),
+                         ("same_as_source", "0.jpg"))
+
+
+if __name__ == '__main__':
+    unittest.main()
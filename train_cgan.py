@@ -7,6 +7,7 @@ import argparse
 from datetime import datetime
 
 from models.font2font_cgan_patchgan import Font2Font
+from util.progressive import parse_widths, train_progressive
 
 parser = argparse.ArgumentParser(description='Train')
 parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
@@ -33,30 +34,73 @@ parser.add_argument('--sample_steps', dest='sample_steps', type=int, default=10,
                     help='number of batches in between two samples are drawn from validation set')
 parser.add_argument('--checkpoint_steps', dest='checkpoint_steps', type=int, default=500,
                     help='number of batches in between two checkpoints')
+parser.add_argument('--prefetch', dest='prefetch', type=int, default=0,
+                    help='number of batches prepared ahead in the background, 0 prepares them in the training loop')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of background workers preparing batches, used with --prefetch')
+parser.add_argument('--worker_processes', dest='worker_processes', type=int, default=0,
+                    help='prepare batches in processes instead of threads, used with --prefetch')
+parser.add_argument('--uint8_input', dest='uint8_input', type=int, default=0,
+                    help='feed uint8 batches and normalize them in the graph')
+parser.add_argument('--input_pipeline', dest='input_pipeline', type=int, default=0,
+                    help='read the train batches by a tf.data pipeline in the graph instead of feed_dict')
+parser.add_argument('--decoded_cache', dest='decoded_cache', type=int, default=0,
+                    help='MB of decoded examples kept in memory across epochs, 0 decodes every epoch again')
+parser.add_argument('--shuffle_buffer', dest='shuffle_buffer', type=int, default=0,
+                    help='stream the train shards through a shuffle buffer of this many examples, '
+                         '0 maps every example')
+parser.add_argument('--fused_step', dest='fused_step', type=int, default=0,
+                    help='update D and G from one shared forward pass in a single session run')
+parser.add_argument('--g_updates', dest='g_updates', type=int, default=2,
+                    help='number of G updates per step, used with --fused_step')
+parser.add_argument('--summary_steps', dest='summary_steps', type=int, default=50,
+                    help='number of steps between the loss summaries, each the mean over those steps')
+parser.add_argument('--progressive_widths', dest='progressive_widths', type=str, default='',
+                    help='comma separated lower widths, e.g. 64,128, trained in turn before image_size, '
+                         'each starting from the weights of the previous one')
+parser.add_argument('--stage_epochs', dest='stage_epochs', type=int, default=5,
+                    help='number of epochs of each of --progressive_widths')
+parser.add_argument('--target_l1', dest='target_l1', type=float, default=0,
+                    help='stop once the val l1_loss at the end of an epoch reaches it and report the time, '
+                         '0 trains all epochs')
 
 args = parser.parse_args()
 
 
+def build_model(sess, width):
+    model = Font2Font(args.experiment_dir, batch_size=args.batch_size, experiment_id=args.experiment_id,
+                      input_width=width, output_width=width, L1_penalty=args.L1_penalty,
+                      Lconst_penalty=args.Lconst_penalty, Ltv_penalty=args.Ltv_penalty,
+                      Lssim_penalty=args.Lssim_penalty, uint8_input=args.uint8_input,
+                      input_pipeline=args.input_pipeline, data_width=args.image_size)
+    model.register_session(sess)
+    model.build_model(is_training=True)
+    return model
+
+
 def main(_):
     start = datetime.now()
     print("Begin time: {}".format(start.isoformat(timespec='seconds')))
 
     print("Args:{}".format(args))
 
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
+    train_args = dict(lr=args.lr, resume=args.resume, schedule=args.schedule, freeze_encoder=args.freeze_encoder,
+                      sample_steps=args.sample_steps, checkpoint_steps=args.checkpoint_steps,
+                      prefetch=args.prefetch, num_workers=args.num_workers, use_processes=args.worker_processes,
+                      cache_bytes=args.decoded_cache << 20, shuffle_buffer=args.shuffle_buffer,
+                      fused=args.fused_step, g_updates=args.g_updates, summary_steps=args.summary_steps)
 
-    with tf.Session(config=config) as sess:
-        model = Font2Font(args.experiment_dir, batch_size=args.batch_size, experiment_id=args.experiment_id,
-                          input_width=args.image_size, output_width=args.image_size, L1_penalty=args.L1_penalty,
-                          Lconst_penalty=args.Lconst_penalty, Ltv_penalty=args.Ltv_penalty,
-                          Lssim_penalty=args.Lssim_penalty)
-        model.register_session(sess)
-        model.build_model(is_training=True)
+    widths = parse_widths(args.progressive_widths)
+    if widths:
+        train_progressive(build_model, widths + [args.image_size], args.stage_epochs, args.epoch,
+                          target_l1=args.target_l1, **train_args)
+    else:
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
 
-        model.train(lr=args.lr, epoch=args.epoch, resume=args.resume,
-                    schedule=args.schedule, freeze_encoder=args.freeze_encoder,
-                    sample_steps=args.sample_steps, checkpoint_steps=args.checkpoint_steps)
+        with tf.Session(config=config) as sess:
+            model = build_model(sess, args.image_size)
+            model.train(epoch=args.epoch, target_l1=args.target_l1, **train_args)
 
     end = datetime.now()
     print("Ending time: {}".format(end))
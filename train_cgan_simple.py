@@ -34,6 +34,23 @@ parser.add_argument('--sample_steps', dest='sample_steps', type=int, default=10,
                     help='number of batches in between two samples are drawn from validation set')
 parser.add_argument('--checkpoint_steps', dest='checkpoint_steps', type=int, default=500,
                     help='number of batches in between two checkpoints')
+parser.add_argument('--prefetch', dest='prefetch', type=int, default=0,
+                    help='number of batches prepared ahead in the background, 0 prepares them in the training loop')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of background workers preparing batches, used with --prefetch')
+parser.add_argument('--worker_processes', dest='worker_processes', type=int, default=0,
+                    help='prepare batches in processes instead of threads, used with --prefetch')
+parser.add_argument('--uint8_input', dest='uint8_input', type=int, default=0,
+                    help='feed uint8 batches and normalize them in the graph')
+parser.add_argument('--input_pipeline', dest='input_pipeline', type=int, default=0,
+                    help='read the train batches by a tf.data pipeline in the graph instead of feed_dict')
+parser.add_argument('--decoded_cache', dest='decoded_cache', type=int, default=0,
+                    help='MB of decoded examples kept in memory across epochs, 0 decodes every epoch again')
+parser.add_argument('--shuffle_buffer', dest='shuffle_buffer', type=int, default=0,
+                    help='stream the train shards through a shuffle buffer of this many examples, '
+                         '0 maps every example')
+parser.add_argument('--summary_steps', dest='summary_steps', type=int, default=50,
+                    help='number of steps between the loss summaries, each the mean over those steps')
 
 args = parser.parse_args()
 
@@ -51,13 +68,17 @@ def main(_):
         model = Font2Font(args.experiment_dir, batch_size=args.batch_size, experiment_id=args.experiment_id,
                           input_width=args.image_size, output_width=args.image_size, L1_penalty=args.L1_penalty,
                           Lconst_penalty=args.Lconst_penalty, Ltv_penalty=args.Ltv_penalty,
-                          Lcategory_penalty=args.Lcategory_penalty)
+                          Lcategory_penalty=args.Lcategory_penalty, uint8_input=args.uint8_input,
+                          input_pipeline=args.input_pipeline)
         model.register_session(sess)
         model.build_model(is_training=True)
 
         model.train(lr=args.lr, epoch=args.epoch, resume=args.resume,
                     schedule=args.schedule, freeze_encoder=args.freeze_encoder,
-                    sample_steps=args.sample_steps, checkpoint_steps=args.checkpoint_steps)
+                    sample_steps=args.sample_steps, checkpoint_steps=args.checkpoint_steps,
+                    prefetch=args.prefetch, num_workers=args.num_workers, use_processes=args.worker_processes,
+                    cache_bytes=args.decoded_cache << 20, shuffle_buffer=args.shuffle_buffer,
+                    summary_steps=args.summary_steps)
 
     end = datetime.now()
     print("Ending time: {}".format(end))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import numpy as np
+from util.container import SplitPolicy
+
+
+def header_path(path):
+    return path + ".json"
+
+
+class ArrayStoreWriter(object):
+    """
+    Append fixed shape uint8 examples into a raw file, the json header next to it
+    keeps the shape so the file can be memory mapped. With packed, the rows of a
+    binary example are stored by np.packbits, 8 pixels per byte
+    """
+
+    def __init__(self, path, packed=False):
+        self.path = path
+        self.packed = packed
+        self.f = open(path, 'wb')
+        self.count = 0
+        self.shape = None
+        self.width = None
+        self.sources = list()
+
+    def write(self, arr, source=None):
+        arr = np.asarray(arr)
+        width = arr.shape[-1]
+        if self.packed:
+            arr = np.packbits(arr != 0, axis=-1)
+        else:
+            arr = arr.astype(np.uint8)
+        if self.shape is None:
+            self.shape = arr.shape
+            self.width = width
+        elif arr.shape != self.shape:
+            raise ValueError("example of shape %s in a store of shape %s" % (arr.shape, self.shape))
+        self.f.write(np.ascontiguousarray(arr).tobytes())
+        self.sources.append(source)
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+        header = {"count": self.count, "shape": list(self.shape or []), "width": self.width,
+                  "packed": self.packed, "dtype": "uint8"}
+        if any(source is not None for source in self.sources):
+            # record index -> the file the example comes from
+            header["sources"] = self.sources
+        with open(header_path(self.path), 'w') as f:
+            json.dump(header, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_array_stores = dict()
+
+
+def open_array_store(path):
+    """
+    ArrayStore of path shared within a process, a pickled ArrayStore is reopened this way
+    """
+    store = _array_stores.get(path)
+    if store is None:
+        store = _array_stores[path] = ArrayStore(path)
+    return store
+
+
+class ArrayStore(object):
+    """
+    Read only, memory mapped view of a store written by ArrayStoreWriter,
+    indexing gives the stored rows without any copy. Pickling only keeps the path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(header_path(path), 'r') as f:
+            header = json.load(f)
+        self.count = header["count"]
+        self.shape = tuple(header["shape"])
+        self.width = header["width"]
+        self.packed = header["packed"]
+        self.sources = header.get("sources")
+        if self.count:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r', shape=(self.count,) + self.shape)
+        else:
+            self.data = np.zeros((0,) + self.shape, dtype=np.uint8)
+
+    def unpack(self, rows):
+        """
+        Packed rows back to 0/1 pixels, works on a single example or a batch of them
+        """
+        return np.unpackbits(rows, axis=-1, count=self.width)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def __reduce__(self):
+        return open_array_store, (self.path,)
+
+    def __len__(self):
+        return self.count
+
+
+class ArrayExampleWriter(object):
+    """
+    Write decoded examples into the train and val array stores, the split of each
+    example is decided by split_policy, by default it goes to val with the probability
+    of train_val_split. With packed, the examples are binary and stored 8 pixels per byte
+    """
+
+    def __init__(self, train_path, val_path, train_val_split=0.1, packed=False, split_policy=None):
+        self.split_policy = split_policy or SplitPolicy(train_val_split)
+        self.ft = ArrayStoreWriter(train_path, packed=packed)
+        self.fv = ArrayStoreWriter(val_path, packed=packed)
+
+    def write(self, img, source=None, char=None):
+        """
+        img is a uint8 image or array, for packed stores a mode "1" image or an
+        array where the non zero pixels are white
+        """
+        if self.split_policy.split(char, source) == "val":
+            self.fv.write(img, source)
+        else:
+            self.ft.write(img, source)
+
+    def close(self):
+        self.ft.close()
+        self.fv.close()
+        print("packaged train examples -> %d, val examples -> %d (%.1f MB)" % (
+            self.ft.count, self.fv.count,
+            (os.path.getsize(self.ft.path) + os.path.getsize(self.fv.path)) / 1048576.0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import json
+import mmap
+import os
+import random
+import struct
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+SPLITS = ("train", "val")
+MANIFEST_NAME = "manifest.json"
+
+# record file layout:
+#   header   magic, version, record count, offset of the index, offset of the metadata
+#   records  the encoded examples back to back
+#   index    RECORD_INDEX_DTYPE entry per record
+#   metadata byte length of the json, then a json list with the source file and split of every record
+# the bytes after the metadata are not part of the file, e.g. the records of an interrupted append.
+# version 1 files have no metadata length, their metadata is the json list at the offset
+RECORD_MAGIC = b"F2FREC\x00\x01"
+RECORD_VERSION = 2
+RECORD_HEADER = struct.Struct("<8sIIQQ")
+RECORD_META_LENGTH = struct.Struct("<Q")
+RECORD_INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("crc32", "<u4"),
+                               ("label", "<i4"), ("codepoint", "<i4")])
+
+
+def content_hash(img_bytes):
+    return hashlib.sha1(img_bytes).hexdigest()
+
+
+def is_record_file(path):
+    with open(path, "rb") as f:
+        return f.read(len(RECORD_MAGIC)) == RECORD_MAGIC
+
+
+def char_codepoint(ch):
+    # only single characters are looked up by codepoint
+    if ch is not None and len(ch) == 1:
+        return ord(ch)
+    return -1
+
+
+class RecordWriter(object):
+    """
+    Write encoded examples into an indexed record file. With append, the records of
+    an existing file are kept and the new ones go after them; the header only points
+    to the new index once close() has written it, so an interrupted append leaves
+    the file as it was.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.entries = list()
+        self.metadata = list()
+        if append and os.path.exists(path):
+            if not is_record_file(path):
+                raise ValueError("%s is a legacy pickle, only record files can be appended to, "
+                                 "package it again with --rebuild 1" % path)
+            with RecordFile(path) as existing:
+                self.entries = existing.index.tolist()
+                self.metadata = existing.metadata
+            self.f = open(path, "r+b")
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(path, "wb")
+            self.f.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, 0, RECORD_HEADER.size,
+                                            RECORD_HEADER.size))
+
+    def write(self, img_bytes, label=0, char=None, source=None, split=None):
+        """
+        Return the index of the new record
+        """
+        offset = self.f.tell()
+        self.f.write(img_bytes)
+        self.entries.append((offset, len(img_bytes), zlib.crc32(img_bytes) & 0xffffffff, label,
+                             char_codepoint(char)))
+        self.metadata.append({"source": source, "split": split})
+        return len(self.entries) - 1
+
+    def close(self):
+        index_offset = self.f.tell()
+        self.f.write(np.array(self.entries, dtype=RECORD_INDEX_DTYPE).tobytes())
+        meta_offset = self.f.tell()
+        meta = json.dumps(self.metadata, ensure_ascii=False).encode("utf-8")
+        self.f.write(RECORD_META_LENGTH.pack(len(meta)))
+        self.f.write(meta)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.seek(0)
+        self.f.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, len(self.entries), index_offset,
+                                        meta_offset))
+        self.f.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_record_files = dict()
+
+
+def open_record_file(path):
+    """
+    RecordFile of path shared within a process, a pickled RecordFile is reopened this way
+    """
+    records = _record_files.get(path)
+    if records is None:
+        records = _record_files[path] = RecordFile(path)
+    return records
+
+
+class RecordFile(object):
+    """
+    Read only, memory mapped record file. Opening only reads the header, the index
+    and the metadata, a record is read when it is fetched by its index or character.
+    Pickling only keeps the path, so examples can be sent to worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        size = os.fstat(self.f.fileno()).st_size
+        if size < RECORD_HEADER.size:
+            raise ValueError("%s is too short for a record file" % path)
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset, meta_offset = RECORD_HEADER.unpack_from(self.mm, 0)
+        if magic != RECORD_MAGIC:
+            raise ValueError("%s is not a record file" % path)
+        if version not in (1, RECORD_VERSION):
+            raise ValueError("%s has unsupported record file version %d" % (path, version))
+        if index_offset + count * RECORD_INDEX_DTYPE.itemsize != meta_offset or meta_offset > size:
+            raise ValueError("%s has a broken index" % path)
+        self.index = np.frombuffer(self.mm, dtype=RECORD_INDEX_DTYPE, count=count, offset=index_offset)
+        if version == 1:
+            # parse the json list only, an interrupted append left records after it
+            meta = self.mm[meta_offset:].decode("utf-8", "replace")
+            self.metadata = json.JSONDecoder().raw_decode(meta)[0]
+        else:
+            meta_start = meta_offset + RECORD_META_LENGTH.size
+            if meta_start > size:
+                raise ValueError("%s has a broken metadata block" % path)
+            meta_length, = RECORD_META_LENGTH.unpack_from(self.mm, meta_offset)
+            if meta_start + meta_length > size:
+                raise ValueError("%s has a broken metadata block" % path)
+            self.metadata = json.loads(self.mm[meta_start:meta_start + meta_length].decode("utf-8"))
+        if len(self.metadata) != count:
+            raise ValueError("%s has %d metadata entries for %d records" % (path, len(self.metadata), count))
+        self._by_codepoint = None
+
+    def read(self, i, verify=False):
+        entry = self.index[i]
+        offset, length = int(entry["offset"]), int(entry["length"])
+        img_bytes = self.mm[offset:offset + length]
+        if verify and zlib.crc32(img_bytes) & 0xffffffff != int(entry["crc32"]):
+            raise ValueError("record %d of %s fails its checksum" % (i, self.path))
+        return img_bytes
+
+    def find(self, ch):
+        """
+        Index of the record of a character, None if it is not in the file
+        """
+        if self._by_codepoint is None:
+            self._by_codepoint = dict((int(cp), i) for i, cp in enumerate(self.index["codepoint"]) if cp >= 0)
+        return self._by_codepoint.get(char_codepoint(ch))
+
+    def get(self, ch, verify=False):
+        i = self.find(ch)
+        if i is None:
+            return None
+        return self.read(i, verify)
+
+    def info(self, i):
+        entry = self.index[i]
+        codepoint = int(entry["codepoint"])
+        return {"label": int(entry["label"]), "char": chr(codepoint) if codepoint >= 0 else None,
+                "source": self.metadata[i]["source"], "split": self.metadata[i]["split"]}
+
+    def validate(self):
+        """
+        Indices of the records out of the file bounds or failing their checksum
+        """
+        size = len(self.mm)
+        bad = list()
+        for i, entry in enumerate(self.index):
+            offset, length = int(entry["offset"]), int(entry["length"])
+            if offset < RECORD_HEADER.size or offset + length > size or \
+                    zlib.crc32(self.mm[offset:offset + length]) & 0xffffffff != int(entry["crc32"]):
+                bad.append(i)
+        return bad
+
+    def __reduce__(self):
+        return open_record_file, (self.path,)
+
+    def close(self):
+        # the index is a view into the map, drop it first
+        self.index = None
+        self.mm.close()
+        self.f.close()
+
+    def __getitem__(self, i):
+        return self.read(i)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+SPLIT_MODES = ("random", "hash")
+
+
+def load_charset_file(path):
+    """
+    Characters of a charset file, one per line or several on a line
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return set(c for c in f.read() if not c.isspace())
+
+
+def hash_fraction(key):
+    """
+    Stable position of key in [0, 1), the same in every run and process
+    """
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16) / float(1 << 32)
+
+
+class SplitPolicy(object):
+    """
+    Decides the split of an example. The characters of train_chars / val_chars always
+    go to that split, e.g. final_train_3000.txt and final_test_500.txt. The others go to
+    val with the probability of train_val_split, either at random or, in the hash mode,
+    by a stable hash of the character, so repackaging gives the same split and a character
+    of several fonts never ends up on both sides. The charsets and the hash mode need the
+    character of every example.
+    """
+
+    def __init__(self, train_val_split=0.1, mode="random", train_chars=None, val_chars=None):
+        if mode not in SPLIT_MODES:
+            raise ValueError("unknown split mode %s, expected one of %s" % (mode, ", ".join(SPLIT_MODES)))
+        self.train_val_split = train_val_split
+        self.mode = mode
+        self.train_chars = train_chars or set()
+        self.val_chars = val_chars or set()
+        self.assigned = dict()
+        overlap = self.train_chars & self.val_chars
+        if overlap:
+            raise ValueError("%d characters are listed for both train and val" % len(overlap))
+
+    @classmethod
+    def from_files(cls, train_val_split=0.1, mode="random", train_charset=None, val_charset=None):
+        return cls(train_val_split, mode, load_charset_file(train_charset) if train_charset else None,
+                   load_charset_file(val_charset) if val_charset else None)
+
+    def split(self, char=None, source=None):
+        if char is None and (self.mode == "hash" or self.train_chars or self.val_chars):
+            raise ValueError("the character of %s is not known, the hash split and charset files need "
+                             "a sample directory with a manifest" % source)
+        if char in self.val_chars:
+            return "val"
+        if char in self.train_chars:
+            return "train"
+        if self.mode == "hash":
+            return "val" if hash_fraction(char) < self.train_val_split else "train"
+        key = char if char is not None else source
+        split = "val" if random.random() < self.train_val_split else "train"
+        if key is not None:
+            # a random decision is remembered, asking again gives the same split
+            split = self.assigned.setdefault(key, split)
+        return split
+
+
+class ExampleWriter(object):
+    """
+    Write examples into the train and val record files, the split of each example is
+    decided by split_policy, by default it goes to val with the probability of
+    train_val_split. With append the examples are added after the records already
+    in the files.
+    """
+
+    def __init__(self, train_path, val_path, train_val_split=0.1, append=False, split_policy=None):
+        self.split_policy = split_policy or SplitPolicy(train_val_split)
+        self.writers = {"train": RecordWriter(train_path, append=append),
+                        "val": RecordWriter(val_path, append=append)}
+
+    def write(self, img_bytes, label=0, char=None, source=None, split=None):
+        """
+        Return the split of the example and its record index in that split, a given
+        split, e.g. the one an example had before, is kept instead of asking the split policy
+        """
+        if split is None:
+            split = self.split_policy.split(char, source)
+        return split, self.writers[split].write(img_bytes, label=label, char=char, source=source, split=split)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        print("packaged train examples -> %d, val examples -> %d" % (len(self.writers["train"]),
+                                                                     len(self.writers["val"])))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Manifest(object):
+    """
+    Book keeping of a sample directory or a packaged dataset, kept as manifest.json.
+    Every live character maps to its sample id, content hash, source file and, once
+    packaged, to its split and record index. Removed characters leave tombstones
+    on their records, so the packaged files only ever grow and the split of an
+    existing example never changes. Characters the fonts do not have are kept as
+    missing, so they are not tried again as long as the fonts stay the same.
+    """
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self.records = OrderedDict()
+        self.next_id = 0
+        self.files = {"train": "train.obj", "val": "val.obj"}
+        self.counts = dict((split, 0) for split in SPLITS)
+        self.tombstones = dict((split, list()) for split in SPLITS)
+        self.missing = list()
+        # content hashes of the fonts the missing characters were tried with
+        self.missing_fonts = None
+        if load and os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def for_dir(cls, dir_path, load=True):
+        return cls(os.path.join(dir_path, MANIFEST_NAME), load=load)
+
+    def load(self):
+        with open(self.path, "r") as f:
+            m = json.load(f, object_pairs_hook=OrderedDict)
+        self.records = m["records"]
+        self.next_id = m["next_id"]
+        self.files = m.get("files", self.files)
+        self.counts = m.get("counts", self.counts)
+        self.tombstones = m.get("tombstones", self.tombstones)
+        self.missing = m.get("missing", self.missing)
+        self.missing_fonts = m.get("missing_fonts", self.missing_fonts)
+
+    def save(self):
+        m = OrderedDict([("version", 1), ("next_id", self.next_id), ("files", self.files),
+                         ("counts", self.counts), ("tombstones", self.tombstones), ("missing", self.missing),
+                         ("missing_fonts", self.missing_fonts), ("records", self.records)])
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(m, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def diff(self, charset):
+        """
+        Characters of charset that are not in the manifest yet, neither live nor
+        missing, and live characters of the manifest that are not in charset anymore
+        """
+        wanted = set(charset)
+        missing = set(self.missing)
+        added = [c for c in OrderedDict.fromkeys(charset) if c not in self.records and c not in missing]
+        removed = [c for c in self.records if c not in wanted]
+        return added, removed
+
+    def add(self, ch, img_bytes, source=None, split=None, index=None, sample_id=None):
+        if sample_id is None:
+            sample_id = self.next_id
+        self.next_id = max(self.next_id, sample_id + 1)
+        record = OrderedDict([("id", sample_id), ("hash", content_hash(img_bytes))])
+        if source is not None:
+            record["source"] = source
+        if split is not None:
+            record["split"] = split
+            record["index"] = index
+            self.counts[split] = max(self.counts[split], index + 1)
+        self.records[ch] = record
+        return record
+
+    def track_missing_fonts(self, font_hashes):
+        """
+        Forget the missing characters when the fonts changed since they were recorded,
+        so the characters are tried again with the new fonts
+        """
+        font_hashes = list(font_hashes)
+        if self.missing_fonts != font_hashes:
+            self.missing = list()
+            self.missing_fonts = font_hashes
+
+    def add_missing(self, ch):
+        if ch not in self.missing:
+            self.missing.append(ch)
+
+    def remove(self, ch):
+        record = self.records.pop(ch)
+        if "split" in record:
+            self.tombstones[record["split"]].append(record["index"])
+        return record
+
+    def split_of_file(self, obj_name):
+        for split, name in self.files.items():
+            if name == obj_name:
+                return split
+        return None
+
+    def __len__(self):
+        return len(self.records)
+
+
+SHARDS_NAME = "shards.json"
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def shard_name(split, index):
+    return "%s-%05d.obj" % (split, index)
+
+
+class ShardManifest(object):
+    """
+    Top level shards.json of a sharded dataset, every shard is a record file listed
+    with its split, record count, size and sha1. A shard is checked against its size
+    and record count cheaply, or against its sha1 with full verification.
+    """
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self.shards = list()
+        if load and os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def for_dir(cls, dir_path, load=True):
+        return cls(os.path.join(dir_path, SHARDS_NAME), load=load)
+
+    def load(self):
+        with open(self.path, "r") as f:
+            m = json.load(f, object_pairs_hook=OrderedDict)
+        self.shards = m["shards"]
+
+    def save(self):
+        m = OrderedDict([("version", 1), ("counts", self.counts()), ("shards", self.shards)])
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(m, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def add(self, file_name, split, count, size, sha1):
+        self.shards.append(OrderedDict([("file", file_name), ("split", split), ("count", count),
+                                        ("bytes", size), ("sha1", sha1)]))
+
+    def counts(self):
+        counts = dict((split, 0) for split in SPLITS)
+        for shard in self.shards:
+            counts[shard["split"]] += shard["count"]
+        return counts
+
+    def shard_paths(self, split, reader=0, num_readers=1):
+        """
+        Shards of a split assigned to one of num_readers parallel readers, round robin
+        """
+        shards = [s for s in self.shards if s["split"] == split]
+        return [os.path.join(os.path.dirname(self.path), s["file"]) for s in shards[reader::num_readers]]
+
+    def verify(self, full=False):
+        """
+        Files of the shards that are missing or do not match the manifest
+        """
+        bad = list()
+        for shard in self.shards:
+            path = os.path.join(os.path.dirname(self.path), shard["file"])
+            try:
+                if os.path.getsize(path) != shard["bytes"]:
+                    bad.append(shard["file"])
+                elif full and file_sha1(path) != shard["sha1"]:
+                    bad.append(shard["file"])
+                elif not full:
+                    with RecordFile(path) as records:
+                        if len(records) != shard["count"]:
+                            bad.append(shard["file"])
+            except (IOError, OSError, ValueError):
+                bad.append(shard["file"])
+        return bad
+
+    def __len__(self):
+        return len(self.shards)
@@ -1,112 +1,608 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from __future__ import absolute_import
+import json
 import pickle
 import numpy as np
-import random
 import os
-from util.uitls import pad_seq, bytes_to_file, read_split_image, shift_and_resize_image, normalize_image
+import threading
+from collections import namedtuple, deque, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from util.uitls import bytes_to_file, read_image, normalize_image
+from util.container import Manifest, MANIFEST_NAME, RecordFile, ShardManifest, is_record_file
+from util.arraystore import ArrayStore
+
+# a memory mapped example of a bit packed store
+PackedExample = namedtuple("PackedExample", ["bits", "store"])
+# an example of a record file, read when its batch is built
+RecordExample = namedtuple("RecordExample", ["records", "index"])
+
+
+def load_tombstones(obj_path):
+    """
+    Records of the examples removed by an incremental rebuild, listed in the manifest
+    """
+    manifest_path = os.path.join(os.path.dirname(obj_path), MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return set()
+    manifest = Manifest(manifest_path)
+    split = manifest.split_of_file(os.path.basename(obj_path))
+    if split is None:
+        return set()
+    return set(manifest.tombstones[split])
+
+
+def iter_pickled_examples(obj_path, tombstones=()):
+    """
+    Examples of a legacy stream of pickled records one by one
+    """
+    with open(obj_path, "rb") as of:
+        index = -1
+        while True:
+            try:
+                e = pickle.load(of)
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, TypeError) as e:
+                raise ValueError("%s: broken record after %d records, %s" % (obj_path, index + 1, e))
+            index += 1
+            if index in tombstones:
+                continue
+            yield e
 
 
 class PickledImageProvider(object):
+    """
+    Examples of a packaged train.obj / val.obj, either an indexed record file, mapped
+    lazily, or the legacy stream of pickled records, read into memory
+    """
+
     def __init__(self, obj_path):
         self.obj_path = obj_path
-        self.examples = self.load_pickled_examples()
+        if is_record_file(obj_path):
+            self.examples = self.load_record_examples()
+        else:
+            self.examples = self.load_pickled_examples()
+
+    def load_record_examples(self):
+        tombstones = load_tombstones(self.obj_path)
+        records = RecordFile(self.obj_path)
+        examples = [RecordExample(records, i) for i in range(len(records)) if i not in tombstones]
+        print("mapped total %d examples" % len(examples))
+        return examples
 
     def load_pickled_examples(self):
-        with open(self.obj_path, "rb") as of:
-            examples = list()
-            while True:
-                try:
-                    e = pickle.load(of)
-                    examples.append(e)
-                    if len(examples) % 1000 == 0:
-                        print("processed %d examples" % len(examples))
-                except EOFError:
-                    break
-                except Exception:
-                    pass
-            print("unpickled total %d examples" % len(examples))
-            return examples
-
-
-def get_batch_iter(examples, batch_size, augment):
-    # the transpose ops requires deterministic
-    # batch size, thus comes the padding
-    padded = pad_seq(examples, batch_size)
+        examples = list()
+        for e in iter_pickled_examples(self.obj_path, load_tombstones(self.obj_path)):
+            examples.append(e)
+            if len(examples) % 1000 == 0:
+                print("processed %d examples" % len(examples))
+        print("unpickled total %d examples" % len(examples))
+        return examples
+
+
+class ArrayStoreProvider(object):
+    """
+    Examples of an array store, either decoded uint8 [H, 2W] images (train.u8 / val.u8)
+    or bit packed bitmaps (train.bits / val.bits). The store is memory mapped, so loading
+    is instant, the examples are views into the page cache shared by every process
+    reading the store, and nothing is decoded when a batch is built
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.store = ArrayStore(store_path)
+        if self.store.packed:
+            self.examples = [PackedExample(self.store[i], self.store) for i in range(len(self.store))]
+        else:
+            self.examples = [self.store[i] for i in range(len(self.store))]
+        print("mapped total %d examples" % len(self.examples))
+
+
+class ShardedProvider(object):
+    """
+    Examples of the record file shards of one split of a sharded dataset. With
+    num_readers, only the shards assigned to this reader are mapped
+    """
+
+    def __init__(self, data_dir, split, reader=0, num_readers=1):
+        self.manifest = ShardManifest.for_dir(data_dir)
+        self.shards = [RecordFile(p) for p in self.manifest.shard_paths(split, reader, num_readers)]
+        self.examples = [RecordExample(records, i) for records in self.shards for i in range(len(records))]
+        print("mapped total %d examples of %d %s shards" % (len(self.examples), len(self.shards), split))
+
+
+class ShuffleBufferProvider(object):
+    """
+    Streams the examples of the record file shards of one split through a shuffle buffer,
+    only buffer_size encoded examples and the shard being read are held in memory, whatever
+    the size of the dataset.
+
+    Randomness: the shards are read in a random order, each example read replaces a uniform
+    pick from the full buffer, which is handed out. With a buffer at least as large as the
+    split, the order is a uniformly random permutation. With a smaller one, an example is
+    handed out on average buffer_size examples after it is read, so examples only mix within
+    a window of about that many examples, and examples of shards far apart in the shard order
+    rarely share a batch. Shards hold neighbouring characters, the buffer should span a few
+    shards at least
+    """
+
+    def __init__(self, data_dir, split, buffer_size=10000, reader=0, num_readers=1):
+        self.manifest = ShardManifest.for_dir(data_dir)
+        self.buffer_size = buffer_size
+        self.paths = self.manifest.shard_paths(split, reader, num_readers)
+        shards = [s for s in self.manifest.shards if s["split"] == split][reader::num_readers]
+        self.count = sum(s["count"] for s in shards)
+        print("streaming total %d examples of %d %s shards, shuffle buffer of %d" % (
+            self.count, len(self.paths), split, buffer_size))
+
+    def read(self, shards):
+        for shard in shards:
+            with RecordFile(self.paths[shard]) as records:
+                for i in range(len(records)):
+                    yield records.read(i)
+
+    def stream(self, rng=None):
+        """
+        Every example once, shuffled by rng, in the order of the shards without one
+        """
+        if rng is None:
+            for example in self.read(range(len(self.paths))):
+                yield example
+            return
+        buffer = list()
+        for example in self.read(rng.permutation(len(self.paths))):
+            if len(buffer) < self.buffer_size:
+                buffer.append(example)
+                continue
+            i = rng.randint(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        for example in buffer:
+            yield example
+
+    def batches(self, batch_size, rng=None):
+        """
+        Example lists of batch_size, the last one is padded with the first examples
+        """
+        first = list()
+        batch = list()
+        for example in self.stream(rng):
+            if len(first) < batch_size:
+                first.append(example)
+            batch.append(example)
+            if len(batch) == batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield (batch + first * batch_size)[:batch_size]
+
+    def head(self, size):
+        return list(islice(self.stream(), size))
 
+
+# dataset files in the order they are looked for
+STORE_EXTENSIONS = (".obj", ".u8", ".bits")
+
+
+def load_provider(path):
+    if path.endswith(".bits") or path.endswith(".u8"):
+        return ArrayStoreProvider(path)
+    return PickledImageProvider(path)
+
+
+def pad_indices(indices, batch_size):
+    """
+    Pad an index array to a multiple of batch_size with its first indices,
+    the transpose ops requires deterministic batch size
+    """
+    padding = -len(indices) % batch_size
+    if padding == 0:
+        return indices
+    return np.concatenate([indices, np.resize(indices, padding)])
+
+
+def get_batch_iter(examples, batch_size, augment, executor=None, prefetch=0, cache=None, uint8=False,
+                   order=None, seeds=None):
+    """
+    Batches of examples in the order of the index array order, by default all of them padded to a
+    multiple of batch_size. The augmentation of every batch comes from its own seed, by default
+    drawn up front, so the batches do not depend on the order the workers build them in
+    """
+    if order is None:
+        order = pad_indices(np.arange(len(examples)), batch_size)
+    starts = range(0, len(order), batch_size)
+    if seeds is None:
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=len(starts)) if augment else [None] * len(starts)
+    batches = ([examples[j] for j in order[i: i + batch_size]] for i in starts)
+    return process_batches(batches, seeds, augment, executor, prefetch, cache, uint8)
+
+
+def process_batches(batches, seeds, augment, executor=None, prefetch=0, cache=None, uint8=False):
+    """
+    Build the batches of an iterable of example lists, each with its augmentation seed,
+    with an executor up to prefetch of them ahead
+    """
     def batch_iter():
-        for i in range(0, len(padded), batch_size):
-            batch = padded[i: i + batch_size]
-            processed = [process(e, augment) for e in batch]
-            # stack into tensor
-            yield np.array(processed).astype(np.float32)
+        for batch, seed in zip(batches, seeds):
+            yield process_batch(batch, augment, seed, cache, uint8)
+
+    def prefetch_iter():
+        # keep prefetch batches in the making while the consumer works on the current one,
+        # they are handed out in submission order, so the batches are the same as batch_iter
+        pending = deque()
+        try:
+            for batch, seed in zip(batches, seeds):
+                pending.append(executor.submit(process_batch, batch, augment, seed, cache, uint8))
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
+    if executor is not None and prefetch > 0:
+        return prefetch_iter()
     return batch_iter()
 
 
-def process(img, augment):
+def batch_executor(num_workers, use_processes=False):
+    """
+    Pool building the batches in the background, threads share the examples as they are,
+    processes get them pickled, record files and array stores are reopened by path
+    """
+    if use_processes:
+        return ProcessPoolExecutor(num_workers)
+    return ThreadPoolExecutor(num_workers)
+
+
+_worker_caches = dict()
+
+
+def worker_cache(max_bytes):
+    """
+    DecodedCache of the current process, a pickled DecodedCache comes back as this one
+    """
+    cache = _worker_caches.get(max_bytes)
+    if cache is None:
+        cache = _worker_caches[max_bytes] = DecodedCache(max_bytes)
+    return cache
+
+
+class DecodedCache(object):
+    """
+    LRU cache of the decoded uint8 [H, 2W] pixels of encoded examples within a budget of
+    max_bytes, so later epochs skip the jpeg decoding. Examples of record files are keyed
+    by file and index, legacy pickled examples by their bytes. Memory mapped array store
+    examples need no decoding and are not cached. Threads share the cache, every worker
+    process keeps its own.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(img):
+        if isinstance(img, RecordExample):
+            return img.records.path, img.index
+        if isinstance(img, bytes):
+            return img
+        return None
+
+    def get(self, key):
+        with self.lock:
+            pixels = self.entries.get(key)
+            if pixels is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return pixels
+
+    def put(self, key, pixels):
+        size = pixels.nbytes + (len(key) if isinstance(key, bytes) else 0)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = pixels
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.total_bytes -= old.nbytes + (len(old_key) if isinstance(old_key, bytes) else 0)
+
+    def report(self):
+        return "decoded cache: %d examples, %.1f MB, %d hits, %d misses, hit rate %.1f%%" % (
+            len(self.entries), self.total_bytes / 1048576.0, self.hits, self.misses,
+            100.0 * self.hits / max(self.hits + self.misses, 1))
+
+    def __reduce__(self):
+        return worker_cache, (self.max_bytes,)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def decode_pixels(img, cache=None):
+    """
+    [H, 2W] pixels of an example in the 0-255 range
+    """
+    key = cache.key(img) if cache is not None else None
+    if key is not None:
+        pixels = cache.get(key)
+        if pixels is None:
+            pixels = decode_pixels(img).astype(np.uint8)
+            cache.put(key, pixels)
+        return pixels
+    if isinstance(img, PackedExample):
+        # 0/1 pixels to the 0/255 range of the decoded images
+        return img.store.unpack(img.bits) * np.uint8(255)
+    if isinstance(img, np.ndarray):
+        return img
+    if isinstance(img, RecordExample):
+        img = img.records.read(img.index)
     img = bytes_to_file(img)
     try:
-        img_A, img_B = read_split_image(img)
-        if augment:
-            # augment the image by:
-            # 1) enlarge the image
-            # 2) random crop the image back to its original size
-            # NOTE: image A and B needs to be in sync as how much
-            # to be shifted
-            w, h = img_A.shape
-            multiplier = random.uniform(1.00, 1.20)
-            # add an eps to prevent cropping issue
-            nw = int(multiplier * w) + 1
-            nh = int(multiplier * h) + 1
-            shift_x = int(np.ceil(np.random.uniform(0.01, nw - w)))
-            shift_y = int(np.ceil(np.random.uniform(0.01, nh - h)))
-            img_A = shift_and_resize_image(img_A, shift_x, shift_y, nw, nh)
-            img_B = shift_and_resize_image(img_B, shift_x, shift_y, nw, nh)
-
-        img_A = normalize_image(img_A)
-        img_B = normalize_image(img_B)
-
-        # 2D to 3D matrix
-        img_A = np.reshape(img_A, [img_A.shape[0], img_A.shape[1], 1])
-        img_B = np.reshape(img_B, [img_B.shape[0], img_B.shape[1], 1])
-
-        return np.concatenate([img_A, img_B], axis=2)
+        return read_image(img)
     finally:
         img.close()
 
 
+def stack_pixels(examples, cache=None):
+    """
+    Pixels of a batch of examples as one [B, H, 2W] array
+    """
+    if all(isinstance(e, PackedExample) for e in examples):
+        # unpack the bits of the whole batch at once
+        return examples[0].store.unpack(np.stack([e.bits for e in examples])) * np.uint8(255)
+    return np.stack([decode_pixels(e, cache) for e in examples])
+
+
+def resample_coords(dst, size, new_size):
+    """
+    Source pixels and weights of bilinear sampling, for the dst coordinates [B, N] of
+    images of size pixels enlarged to new_size [B] pixels
+    """
+    src = (dst + 0.5) * (float(size) / new_size[:, None]) - 0.5
+    src = np.clip(src, 0, size - 1)
+    lo = np.floor(src).astype(np.int64)
+    hi = np.minimum(lo + 1, size - 1)
+    return lo, hi, (src - lo).astype(np.float32)
+
+
+def augment_batch(batch, rng):
+    """
+    Augment a [B, H, W, 2] batch by:
+    1) enlarge every image by a random 1.00-1.20
+    2) random crop the image back to its original size
+    Target and source of an example share the scale and the crop. The crops are
+    sampled bilinearly from the original images, for the whole batch at once
+    """
+    b, h, w = batch.shape[:3]
+    multiplier = rng.uniform(1.00, 1.20, size=b)
+    # add an eps to prevent cropping issue
+    nh = (multiplier * h).astype(np.int64) + 1
+    nw = (multiplier * w).astype(np.int64) + 1
+    shift_y = np.ceil(rng.uniform(0.01, nh - h)).astype(np.int64)
+    shift_x = np.ceil(rng.uniform(0.01, nw - w)).astype(np.int64)
+    y0, y1, fy = resample_coords(np.arange(h)[None, :] + shift_y[:, None], h, nh)
+    x0, x1, fx = resample_coords(np.arange(w)[None, :] + shift_x[:, None], w, nw)
+
+    # bilinear is separable, interpolate the rows first, then the columns
+    bi = np.arange(b)[:, None]
+    fy = fy[:, :, None, None]
+    rows = batch[bi, y0] * (1 - fy) + batch[bi, y1] * fy
+    fx = fx[:, None, :, None]
+    return rows[bi, :, x0].transpose(0, 2, 1, 3) * (1 - fx) + rows[bi, :, x1].transpose(0, 2, 1, 3) * fx
+
+
+def process_batch(examples, augment, seed=None, cache=None, uint8=False):
+    """
+    Normalized [B, H, W, 2] float32 batch of target and source, the augmentation
+    is drawn from seed, decoded examples are kept in cache. With uint8, the batch
+    is left as decoded, [B, H, 2W] uint8 pixels, for models normalizing in the graph
+    """
+    pixels = stack_pixels(examples, cache)
+    if uint8 and not augment:
+        return pixels.astype(np.uint8, copy=False)
+    pixels = pixels.astype(np.float32)
+    side = int(pixels.shape[2] / 2)
+    batch = np.stack([pixels[:, :, :side], pixels[:, :, side:]], axis=3)
+    if augment:
+        batch = augment_batch(batch, np.random.RandomState(seed))
+    if uint8:
+        return np.concatenate([batch[:, :, :, 0], batch[:, :, :, 1]], axis=2).round().astype(np.uint8)
+    return normalize_image(batch)
+
+
+def process(img, augment):
+    return process_batch([img], augment)[0]
+
+
+SAMPLER_NAME = "sampler.json"
+
+
+def write_sampler_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+class EpochSampler(object):
+    """
+    Order of the train examples: every epoch is a permutation of their indices, and the
+    augmentation seeds of its batches, drawn from (seed, epoch), so any epoch can be replayed.
+    The position, the next batch to train, is saved next to a checkpoint, a run resumed from
+    the checkpoint continues at that very batch
+    """
+
+    def __init__(self, num_examples, seed=None):
+        self.num_examples = num_examples
+        self.seed = int(np.random.randint(0, 2 ** 31 - 1)) if seed is None else seed
+        self.epoch = 0
+        self.batch = 0
+        self.step = 0
+        self.lr = None
+
+    def order(self, epoch, batch_size, start=0, shuffle=True):
+        """
+        Example indices of epoch from batch start on, the epoch is padded to a multiple of
+        batch_size with its first indices, and the augmentation seed of every batch. An epoch
+        of None is a new random order
+        """
+        rng = self.rng(epoch)
+        indices = rng.permutation(self.num_examples) if shuffle else np.arange(self.num_examples)
+        indices = pad_indices(indices, batch_size)
+        seeds = rng.randint(0, 2 ** 31 - 1, size=len(indices) // batch_size)
+        return indices[start * batch_size:], seeds[start:]
+
+    def rng(self, epoch):
+        if epoch is None:
+            # an order that is not replayed, new on every call
+            return np.random.RandomState()
+        return np.random.RandomState([self.seed, epoch])
+
+    def advance(self, epoch, batch, step, lr, batch_size):
+        """
+        Batch of epoch is trained, it was the step-th of the run at learning rate lr
+        """
+        if (batch + 1) * batch_size >= self.num_examples:
+            self.epoch, self.batch = epoch + 1, 0
+        else:
+            self.epoch, self.batch = epoch, batch + 1
+        self.step = step
+        self.lr = lr
+
+    def save(self, checkpoint_path, writer=None):
+        """
+        Keep the position in sampler.json next to the checkpoint just written at checkpoint_path.
+        With a BackgroundWriter the position as of now is written after the checkpoint queued on it
+        """
+        path = os.path.join(os.path.dirname(checkpoint_path), SAMPLER_NAME)
+        state = {"checkpoint": os.path.basename(checkpoint_path), "seed": self.seed, "epoch": self.epoch,
+                 "batch": self.batch, "step": self.step, "lr": self.lr}
+        if writer is not None:
+            writer.submit(write_sampler_state, path, state)
+        else:
+            write_sampler_state(path, state)
+
+    def restore(self, checkpoint_path):
+        """
+        Continue from the position saved with the checkpoint at checkpoint_path, return
+        False when there is none, e.g. the checkpoint predates the sampler
+        """
+        path = os.path.join(os.path.dirname(checkpoint_path), SAMPLER_NAME)
+        if not os.path.exists(path):
+            return False
+        with open(path, "r") as f:
+            state = json.load(f)
+        if state["checkpoint"] != os.path.basename(checkpoint_path):
+            print("sampler position of %s does not match checkpoint %s" % (state["checkpoint"], checkpoint_path))
+            return False
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.batch = state["batch"]
+        self.step = state["step"]
+        self.lr = state["lr"]
+        print("resume at epoch %d, batch %d, step %d" % (self.epoch, self.batch, self.step))
+        return True
+
+
 class TrainDataProvider(object):
-    def __init__(self, data_dir, train_name="train.obj", val_name="val.obj"):
+    """
+    With prefetch, up to prefetch batches are built ahead by num_workers background
+    threads, or processes with use_processes, while the training runs. With cache_bytes,
+    decoded examples are kept in a DecodedCache of that size across epochs. With uint8,
+    the batches are [B, H, 2W] uint8 pixels as decoded. With shuffle_buffer, the train
+    examples of a sharded dataset are streamed through a ShuffleBufferProvider of that size
+    """
+
+    def __init__(self, data_dir, train_name="train.obj", val_name="val.obj", prefetch=0, num_workers=1,
+                 use_processes=False, cache_bytes=0, uint8=False, shuffle_buffer=0):
         self.data_dir = data_dir
+        self.uint8 = uint8
+        self.prefetch = prefetch
+        self.executor = batch_executor(num_workers, use_processes) if prefetch > 0 else None
+        self.cache = DecodedCache(cache_bytes) if cache_bytes > 0 else None
 
-        self.train = PickledImageProvider(os.path.join(self.data_dir, train_name))
-        self.val = PickledImageProvider(os.path.join(self.data_dir, val_name))
-        print("train examples -> %d, val examples -> %d" % (len(self.train.examples), len(self.val.examples)))
+        if not os.path.exists(os.path.join(self.data_dir, train_name)) and \
+                ShardManifest.for_dir(self.data_dir).exists():
+            # record file shards listed in shards.json
+            if shuffle_buffer > 0:
+                self.train = ShuffleBufferProvider(self.data_dir, "train", shuffle_buffer)
+            else:
+                self.train = ShardedProvider(self.data_dir, "train")
+            self.val = ShardedProvider(self.data_dir, "val")
+        elif shuffle_buffer > 0:
+            raise ValueError("%s has no shards.json, streaming needs a dataset packaged with --shard_size" %
+                             self.data_dir)
+        else:
+            if not os.path.exists(os.path.join(self.data_dir, train_name)):
+                # decoded or bit packed array stores
+                for ext in STORE_EXTENSIONS:
+                    if os.path.exists(os.path.join(self.data_dir, "train" + ext)):
+                        train_name, val_name = "train" + ext, "val" + ext
+                        break
+            self.train = load_provider(os.path.join(self.data_dir, train_name))
+            self.val = load_provider(os.path.join(self.data_dir, val_name))
+        self.streaming = isinstance(self.train, ShuffleBufferProvider)
+        self.num_train = self.train.count if self.streaming else len(self.train.examples)
+        print("train examples -> %d, val examples -> %d" % (self.num_train, len(self.val.examples)))
+        self.sampler = EpochSampler(self.num_train)
 
-    def get_train_iter(self, batch_size, shuffle=True):
-        training_examples = self.train.examples[:]
-        if shuffle:
-            np.random.shuffle(training_examples)
-        return get_batch_iter(training_examples, batch_size, augment=True)
+    def get_train_iter(self, batch_size, shuffle=True, epoch=None, start=0):
+        """
+        Batches of epoch from batch start on, the order of an epoch is the same in every run
+        with the sampler seed. Without epoch, every call gives a new random order
+        """
+        if self.cache is not None and (self.cache.hits or self.cache.misses):
+            print(self.cache.report())
+        if self.streaming:
+            rng = self.sampler.rng(epoch)
+            num_batches = int(np.ceil(self.num_train / float(batch_size)))
+            seeds = rng.randint(0, 2 ** 31 - 1, size=num_batches)
+            # the skipped batches of a resumed epoch are read, but not built
+            batches = islice(self.train.batches(batch_size, rng if shuffle else None), start, None)
+            return process_batches(batches, seeds[start:], augment=True, executor=self.executor,
+                                   prefetch=self.prefetch, cache=self.cache, uint8=self.uint8)
+        order, seeds = self.train_order(batch_size, epoch, start, shuffle)
+        return get_batch_iter(self.train.examples, batch_size, augment=True, executor=self.executor,
+                              prefetch=self.prefetch, cache=self.cache, uint8=self.uint8, order=order, seeds=seeds)
+
+    def train_order(self, batch_size, epoch=None, start=0, shuffle=True):
+        return self.sampler.order(epoch, batch_size, start, shuffle)
 
     def get_val_iter(self, batch_size, shuffle=True):
+        """
+        Every val example once, the last batch is short instead of padded with duplicates
+        """
         val_examples = self.val.examples[:]
 
         if shuffle:
             np.random.shuffle(val_examples)
-        return get_batch_iter(val_examples, batch_size, augment=False)
+        return get_batch_iter(val_examples, batch_size, augment=False, executor=self.executor,
+                              prefetch=self.prefetch, cache=self.cache, uint8=self.uint8,
+                              order=np.arange(len(val_examples)))
 
     def get_train_sample(self, size, shuffle=False):
+        if self.streaming:
+            return process_batch(self.train.head(size), augment=False, cache=self.cache, uint8=self.uint8)
         train_samples = self.train.examples[:]
         if shuffle:
             np.random.shuffle(train_samples)
 
         train_samples = train_samples[:size]
-        processed = [process(e, augment=False) for e in train_samples]
-
-        return np.array(processed).astype(np.float32)
+        return process_batch(train_samples, augment=False, cache=self.cache, uint8=self.uint8)
 
     def get_val(self, size, shuffle=False):
         val_examples = self.val.examples[:]
@@ -115,24 +611,61 @@ class TrainDataProvider(object):
             np.random.shuffle(val_examples)
 
         val_examples = val_examples[0: size]
-
-        processed = [process(e, augment=False) for e in val_examples]
-
-        return np.array(processed).astype(np.float32)
+        return process_batch(val_examples, augment=False, cache=self.cache, uint8=self.uint8)
 
     def compute_total_batch_num(self, batch_size):
         """Total padded batch num"""
-        return int(np.ceil(len(self.train.examples) / float(batch_size)))
+        return int(np.ceil(self.num_train / float(batch_size)))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
 
 class InjectDataProvider(object):
-    def __init__(self, obj_path):
-        self.data = PickledImageProvider(obj_path)
-        print("examples -> %d" % len(self.data.examples))
+    """
+    Source examples of an inference job, streamed: an example is only read when its batch
+    is built, so the memory stays flat whatever the size of the job. The last batch is
+    short unless padded
+    """
+
+    def __init__(self, obj_path, uint8=False):
+        self.obj_path = obj_path
+        self.uint8 = uint8
+        self.count = None
+        print("examples -> %d" % len(self))
+
+    def iter_examples(self):
+        if self.obj_path.endswith(".bits") or self.obj_path.endswith(".u8"):
+            store = ArrayStore(self.obj_path)
+            for i in range(len(store)):
+                yield PackedExample(store[i], store) if store.packed else store[i]
+        elif is_record_file(self.obj_path):
+            tombstones = load_tombstones(self.obj_path)
+            records = RecordFile(self.obj_path)
+            for i in range(len(records)):
+                if i not in tombstones:
+                    yield RecordExample(records, i)
+        else:
+            for e in iter_pickled_examples(self.obj_path, load_tombstones(self.obj_path)):
+                yield e
 
     def get_iter(self, batch_size):
-        examples = self.data.examples[:]
-        batch_iter = get_batch_iter(examples, batch_size, augment=False)
-        for images in batch_iter:
-            yield images
+        """
+        Batches as soon as their examples are read, the last one may be short
+        """
+        batch = list()
+        for e in self.iter_examples():
+            batch.append(e)
+            if len(batch) == batch_size:
+                yield process_batch(batch, augment=False, uint8=self.uint8)
+                batch = list()
+        if batch:
+            yield process_batch(batch, augment=False, uint8=self.uint8)
 
+    def __len__(self):
+        if self.count is None:
+            # a legacy pickle is counted by reading it through once
+            self.count = sum(1 for _ in self.iter_examples())
+        return self.count
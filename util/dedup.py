@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+# different glyphs of two fonts are often a few bits apart at 8x8, the target and
+# source halves of an example are compared on a finer hash
+FALLBACK_HASH_SIZE = 16
+
+
+def dhash(img, hash_size=8):
+    """
+    Difference hash, the signs of the horizontal gradients of a (hash_size + 1) x hash_size
+    thumbnail as a hash_size * hash_size bit integer. Near identical glyphs get hashes a
+    few bits apart.
+    """
+    small = np.asarray(img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits((small[:, 1:] > small[:, :-1]).flatten())
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def pair_hashes(img, hash_size=8):
+    """
+    dhash of the target (left) and the source (right) half of an example
+    """
+    w, h = img.size
+    side = w // 2
+    return dhash(img.crop((0, 0, side, h)), hash_size), dhash(img.crop((side, 0, w, h)), hash_size)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class HammingIndex(object):
+    """
+    Multi index hashing: the hashes are cut into max_distance + 1 bands with one exact
+    lookup table per band. Two hashes at most max_distance bits apart agree on at least
+    one band, so only the hashes sharing a band are compared.
+    """
+
+    def __init__(self, bits, max_distance):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        edges = [bits * i // bands for i in range(bands + 1)]
+        self.bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+        self.tables = [dict() for _ in self.bands]
+        self.values = list()
+
+    def add(self, h, value):
+        self.values.append((h, value))
+        n = len(self.values) - 1
+        for (shift, mask), table in zip(self.bands, self.tables):
+            table.setdefault((h >> shift) & mask, list()).append(n)
+
+    def query(self, h):
+        """
+        Closest (distance, value) within max_distance, None if there is none
+        """
+        seen = set()
+        best = None
+        for (shift, mask), table in zip(self.bands, self.tables):
+            for n in table.get((h >> shift) & mask, ()):
+                if n in seen:
+                    continue
+                seen.add(n)
+                d = hamming(h, self.values[n][0])
+                if d <= self.max_distance and (best is None or d < best[0]):
+                    best = (d, self.values[n][1])
+        return best
+
+    def __len__(self):
+        return len(self.values)
+
+
+class DuplicateFinder(object):
+    """
+    Finds the examples whose target and source halves both nearly match an example seen
+    before ("duplicate", or "leak" when the two are in different splits), and the examples
+    whose target is nearly the source glyph itself ("same_as_source", usually a target
+    font falling back to the source shape). Look-alike characters, e.g. 千/干 or 晴/睛, are
+    a few 8x8 dhash bits apart, so a near match only counts between examples of the same
+    character, at most max_distance bits apart over both halves. Examples of an unknown
+    character only match an example with the same 16x16 dhash of both halves. The target
+    and source are compared on the 16x16 dhash, by default they have to match exactly, as
+    a fallback glyph renders the same.
+    """
+
+    def __init__(self, max_distance=4, fallback_distance=0):
+        self.max_distance = max_distance
+        self.fallback_distance = fallback_distance
+        # character -> HammingIndex of its examples
+        self.indexes = dict()
+        # exact 16x16 pair hashes of the examples of unknown characters
+        self.exact = dict()
+        self.counts = {"duplicate": 0, "leak": 0, "same_as_source": 0}
+
+    def check(self, key, img, split, char=None):
+        """
+        Return (kind, key of the matching example) for a near duplicate, else None
+        and the example is indexed
+        """
+        target, source = pair_hashes(img, FALLBACK_HASH_SIZE)
+        if hamming(target, source) <= self.fallback_distance:
+            self.counts["same_as_source"] += 1
+            return "same_as_source", key
+        if char is None:
+            h = (target, source)
+            match = self.exact.get(h)
+            if match is None:
+                self.exact[h] = (key, split)
+        else:
+            target, source = pair_hashes(img)
+            h = (target << HASH_BITS) | source
+            index = self.indexes.get(char)
+            if index is None:
+                index = self.indexes[char] = HammingIndex(2 * HASH_BITS, self.max_distance)
+            match = index.query(h)
+            if match is not None:
+                match = match[1]
+            else:
+                index.add(h, (key, split))
+        if match is None:
+            return None
+        other_key, other_split = match
+        kind = "duplicate" if other_split == split else "leak"
+        self.counts[kind] += 1
+        return kind, other_key
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import struct
+
+# a noncharacter that never appears in a cmap, drawing it gives the .notdef glyph of a font
+NOTDEF_PROBE = u"\uffff"
+
+
+def _u16(data, offset):
+    return struct.unpack_from(">H", data, offset)[0]
+
+
+def _u32(data, offset):
+    return struct.unpack_from(">I", data, offset)[0]
+
+
+def _find_table(data, tag, font_index=0):
+    offset = 0
+    if data[:4] == b"ttcf":
+        # font collection, jump to the table directory of the selected font
+        offset = _u32(data, 12 + 4 * font_index)
+    num_tables = _u16(data, offset + 4)
+    for i in range(num_tables):
+        record = offset + 12 + 16 * i
+        if data[record:record + 4] == tag:
+            return _u32(data, record + 8)
+    raise ValueError("font has no %s table" % tag.decode("ascii"))
+
+
+def _format4_codepoints(data, offset):
+    seg_count = _u16(data, offset + 6) // 2
+    end_codes = offset + 14
+    start_codes = end_codes + 2 * seg_count + 2
+    id_deltas = start_codes + 2 * seg_count
+    id_range_offsets = id_deltas + 2 * seg_count
+
+    codepoints = set()
+    for i in range(seg_count):
+        end = _u16(data, end_codes + 2 * i)
+        start = _u16(data, start_codes + 2 * i)
+        delta = struct.unpack_from(">h", data, id_deltas + 2 * i)[0]
+        range_offset_pos = id_range_offsets + 2 * i
+        range_offset = _u16(data, range_offset_pos)
+        for c in range(start, end + 1):
+            if c == 0xFFFF:
+                continue
+            if range_offset == 0:
+                gid = (c + delta) & 0xFFFF
+            else:
+                gid = _u16(data, range_offset_pos + range_offset + 2 * (c - start))
+                if gid != 0:
+                    gid = (gid + delta) & 0xFFFF
+            if gid != 0:
+                codepoints.add(c)
+    return codepoints
+
+
+def _format12_codepoints(data, offset):
+    num_groups = _u32(data, offset + 12)
+    codepoints = set()
+    for i in range(num_groups):
+        group = offset + 16 + 12 * i
+        start, end, start_gid = struct.unpack_from(">III", data, group)
+        # only the first code point of a group starting at glyph 0 maps to .notdef
+        if start_gid == 0:
+            start += 1
+        codepoints.update(range(start, end + 1))
+    return codepoints
+
+
+def read_cmap_codepoints(font_path, font_index=0):
+    """
+    Parse the unicode subtables of the font cmap and return the code points
+    that are mapped to a real glyph (glyph id != 0)
+    """
+    with open(font_path, "rb") as f:
+        data = f.read()
+
+    cmap = _find_table(data, b"cmap", font_index)
+    num_subtables = _u16(data, cmap + 2)
+
+    codepoints = set()
+    parsed = 0
+    for i in range(num_subtables):
+        platform_id, encoding_id, sub_offset = struct.unpack_from(">HHI", data, cmap + 4 + 8 * i)
+        # unicode platform, or windows unicode BMP / full repertoire
+        if not (platform_id == 0 or (platform_id == 3 and encoding_id in (1, 10))):
+            continue
+        offset = cmap + sub_offset
+        fmt = _u16(data, offset)
+        if fmt == 4:
+            codepoints |= _format4_codepoints(data, offset)
+            parsed += 1
+        elif fmt == 12:
+            codepoints |= _format12_codepoints(data, offset)
+            parsed += 1
+
+    if not parsed:
+        raise ValueError("font %s has no supported unicode cmap subtable" % font_path)
+    return codepoints
+
+
+def bitmap_digest(img):
+    """
+    Stable digest of the raw pixels of an image, unlike hash() it is the same in every process
+    """
+    return hashlib.md5(img.tobytes()).hexdigest()
+
+
+class FontCoverage(object):
+    """
+    Answer "does the font have a glyph for this character" from the cmap of the font,
+    without rendering. If the cmap can not be parsed every character is assumed to be
+    covered and only the rendered-bitmap check (blank or .notdef box) applies.
+    """
+
+    def __init__(self, font_path, font_index=0):
+        self.font_path = font_path
+        try:
+            self.codepoints = frozenset(read_cmap_codepoints(font_path, font_index))
+        except (IOError, ValueError, struct.error) as e:
+            print("fail to read cmap of %s: %s" % (font_path, e))
+            self.codepoints = None
+        self.notdef_digests = set()
+
+    def add_notdef_bitmap(self, img):
+        self.notdef_digests.add(bitmap_digest(img))
+
+    def has_glyph(self, ch):
+        if self.codepoints is None:
+            return True
+        return all(ord(c) in self.codepoints for c in ch)
+
+    def is_missing_bitmap(self, img):
+        lo, hi = img.getextrema()
+        if lo == hi:
+            # nothing drawn
+            return True
+        return bitmap_digest(img) in self.notdef_digests
+
+    def __len__(self):
+        return len(self.codepoints) if self.codepoints is not None else 0
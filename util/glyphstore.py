@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import os
+import zlib
+from collections import namedtuple, OrderedDict
+from PIL import Image
+
+# everything a rendered glyph depends on, the font is identified by its content
+GlyphKey = namedtuple("GlyphKey", ["font_hash", "char", "char_size", "canvas_size", "x_offset", "y_offset", "mode"])
+
+_font_hashes = dict()
+
+
+def font_file_hash(font_path):
+    """
+    sha1 of the font file content, computed once per path
+    """
+    digest = _font_hashes.get(font_path)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(font_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        _font_hashes[font_path] = digest
+    return digest
+
+
+class GlyphStore(object):
+    """
+    In memory store of rendered glyphs keyed by GlyphKey, so a glyph rendered once
+    can be paired with any number of other fonts. With a capacity, the least
+    recently used glyphs are dropped first.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.glyphs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, ch, font, canvas_size, x_offset, y_offset, mode="L"):
+        return GlyphKey(font_file_hash(font.path), ch, font.size, canvas_size, x_offset, y_offset, mode)
+
+    def get(self, key):
+        img = self.glyphs.get(key)
+        if img is None:
+            self.misses += 1
+            return None
+        self.glyphs.move_to_end(key)
+        self.hits += 1
+        return img
+
+    def put(self, key, img):
+        self.glyphs[key] = img
+        self.glyphs.move_to_end(key)
+        if self.capacity is not None:
+            while len(self.glyphs) > self.capacity:
+                self.glyphs.popitem(last=False)
+
+    def __len__(self):
+        return len(self.glyphs)
+
+
+class GlyphCache(object):
+    """
+    Persistent glyph raster cache in a directory. A glyph is stored zlib compressed in
+    a file addressed by the sha1 of its GlyphKey, so any run with the same font content
+    and render settings hits it. Once the cache grows over max_bytes the least recently
+    used glyphs are evicted. A small in memory GlyphStore sits in front of the disk.
+
+    Several processes can share a cache directory, files are replaced atomically. Every
+    process accounts only for the files it has seen, trim() rescans the directory and
+    brings the whole cache back under the budget.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30, memory_capacity=64):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory = GlyphStore(capacity=memory_capacity)
+        self.hits = 0
+        self.misses = 0
+        # glyph file -> size, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        files = list()
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".glyph"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        files.sort()
+        self.entries = OrderedDict((path, size) for _, path, size in files)
+        self.total_bytes = sum(self.entries.values())
+
+    def key(self, ch, font, canvas_size, x_offset, y_offset, mode="L"):
+        return GlyphKey(font_file_hash(font.path), ch, font.size, canvas_size, x_offset, y_offset, mode)
+
+    def glyph_path(self, key):
+        codepoints = "-".join("%x" % ord(c) for c in key.char)
+        name = "|".join(str(v) for v in (key.font_hash, codepoints, key.char_size, key.canvas_size,
+                                         key.x_offset, key.y_offset, key.mode))
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".glyph")
+
+    def _touch(self, path, size):
+        self.entries.pop(path, None)
+        self.entries[path] = size
+
+    def get(self, key):
+        img = self.memory.get(key)
+        if img is not None:
+            self.hits += 1
+            return img
+
+        path = self.glyph_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            img = Image.frombytes(key.mode, (key.canvas_size, key.canvas_size), zlib.decompress(data))
+            # the file mtime keeps the recency across runs
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, zlib.error):
+            self.misses += 1
+            return None
+
+        self._touch(path, len(data))
+        self.memory.put(key, img)
+        self.hits += 1
+        return img
+
+    def put(self, key, img):
+        self.memory.put(key, img)
+
+        path = self.glyph_path(key)
+        data = zlib.compress(img.tobytes())
+        glyph_dir = os.path.dirname(path)
+        if not os.path.exists(glyph_dir):
+            os.makedirs(glyph_dir, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self.total_bytes += len(data) - self.entries.get(path, 0)
+        self._touch(path, len(data))
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def trim(self):
+        self.scan()
+        self.evict()
+
+    def __len__(self):
+        return len(self.entries)
@@ -5,6 +5,28 @@ import tensorflow as tf
 import numpy as np
 
 
+def image_pair_input(batch_size, width, channels, uint8=False, name="real_A_and_B_images", default=None):
+    """
+    Placeholder of a batch of target and source images, and the [batch, width, width, channels]
+    tensor in (-1, 1) the model works on, a batch_size of None takes batches of any size. The
+    uint8 placeholder takes the examples as they are decoded, [batch, width, 2 * width] target |
+    source, scaling and split happen in the graph. With a default, e.g. the batch of an input
+    pipeline, the placeholder needs no feeding
+    """
+    def placeholder(dtype, shape):
+        if default is None:
+            return tf.placeholder(dtype, shape, name=name)
+        return tf.placeholder_with_default(default, shape, name=name)
+
+    if not uint8:
+        data = placeholder(tf.float32, [batch_size, width, width, channels])
+        return data, data
+    assert channels == 2, "uint8 input holds one grayscale target and source"
+    data = placeholder(tf.uint8, [batch_size, width, 2 * width])
+    images = tf.cast(data, tf.float32) / 127.5 - 1.
+    return data, tf.stack([images[:, :, :width], images[:, :, width:]], axis=3)
+
+
 def batch_norm(x, is_training, epsilon=1e-5, decay=0.9, scope="batch_norm"):
     return tf.contrib.layers.batch_norm(x, decay=decay, updates_collections=None, epsilon=epsilon,
                                         scale=True, is_training=is_training, scope=scope)
@@ -19,23 +41,32 @@ def conv2d(x, output_filters, kh=5, kw=5, sh=2, sw=2, stddev=0.02, scope="conv2d
         Wconv = tf.nn.conv2d(x, W, strides=[1, sh, sw, 1], padding='SAME')
 
         biases = tf.get_variable('b', [output_filters], initializer=tf.constant_initializer(0.0))
-        Wconv_plus_b = tf.reshape(tf.nn.bias_add(Wconv, biases), Wconv.get_shape())
+        Wconv_plus_b = tf.nn.bias_add(Wconv, biases)
 
         return Wconv_plus_b
 
 
 def deconv2d(x, output_shape, kh=5, kw=5, sh=2, sw=2, stddev=0.02, scope="deconv2d"):
+    """
+    output_shape is [batch, height, width, channels], a batch of None is the batch size
+    x has when the graph runs
+    """
     with tf.variable_scope(scope):
         # filter : [height, width, output_channels, in_channels]
         input_shape = x.get_shape().as_list()
         W = tf.get_variable('W', [kh, kw, output_shape[-1], input_shape[-1]],
                             initializer=tf.random_normal_initializer(stddev=stddev))
 
-        deconv = tf.nn.conv2d_transpose(x, W, output_shape=output_shape,
+        if output_shape[0] is None:
+            dynamic_shape = tf.stack([tf.shape(x)[0]] + list(output_shape[1:]))
+        else:
+            dynamic_shape = output_shape
+        deconv = tf.nn.conv2d_transpose(x, W, output_shape=dynamic_shape,
                                         strides=[1, sh, sw, 1])
+        deconv.set_shape(output_shape)
 
         biases = tf.get_variable('b', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-        deconv_plus_b = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
+        deconv_plus_b = tf.nn.bias_add(deconv, biases)
 
         return deconv_plus_b
 
@@ -44,6 +75,13 @@ def lrelu(x, leak=0.2):
     return tf.maximum(x, leak * x)
 
 
+def flatten(x):
+    """
+    [batch, ...] -> [batch, features], the batch size may be unknown until the graph runs
+    """
+    return tf.reshape(x, [-1, x.get_shape()[1:].num_elements()])
+
+
 def fc(x, output_size, stddev=0.02, scope="fc"):
     with tf.variable_scope(scope):
         shape = x.get_shape().as_list()
@@ -54,6 +92,18 @@ def fc(x, output_size, stddev=0.02, scope="fc"):
         return tf.matmul(x, W) + b
 
 
+def fused_train_op(d_optimizer, d_loss, d_vars, g_optimizer, g_loss, g_vars):
+    """
+    Update D and G in one run with the gradients of a single shared forward pass, every
+    gradient is computed before the first variable changes. The optimizers may be the ones
+    of separate D and G updates, the slots are shared
+    """
+    d_grads = d_optimizer.compute_gradients(d_loss, var_list=d_vars)
+    g_grads = g_optimizer.compute_gradients(g_loss, var_list=g_vars)
+    with tf.control_dependencies([grad for grad, _ in d_grads + g_grads if grad is not None]):
+        return tf.group(d_optimizer.apply_gradients(d_grads), g_optimizer.apply_gradients(g_grads))
+
+
 def init_embedding(size, dimension, stddev=0.01, scope="embedding"):
     with tf.variable_scope(scope):
         return tf.get_variable("E", [size, 1, 1, dimension], tf.float32,
@@ -62,16 +112,15 @@ def init_embedding(size, dimension, stddev=0.01, scope="embedding"):
 
 def conditional_instance_norm(x, ids, labels_num, mixed=False, scope="conditional_instance_norm"):
     with tf.variable_scope(scope):
-        shape = x.get_shape().as_list()
-        batch_size, output_filters = shape[0], shape[-1]
+        output_filters = x.get_shape().as_list()[-1]
         scale = tf.get_variable("scale", [labels_num, output_filters], tf.float32, tf.constant_initializer(1.0))
         shift = tf.get_variable("shift", [labels_num, output_filters], tf.float32, tf.constant_initializer(0.0))
 
         mu, sigma = tf.nn.moments(x, [1, 2], keep_dims=True)
         norm = (x - mu) / tf.sqrt(sigma + 1e-5)
 
-        batch_scale = tf.reshape(tf.nn.embedding_lookup([scale], ids=ids), [batch_size, 1, 1, output_filters])
-        batch_shift = tf.reshape(tf.nn.embedding_lookup([shift], ids=ids), [batch_size, 1, 1, output_filters])
+        batch_scale = tf.reshape(tf.nn.embedding_lookup([scale], ids=ids), [-1, 1, 1, output_filters])
+        batch_shift = tf.reshape(tf.nn.embedding_lookup([shift], ids=ids), [-1, 1, 1, output_filters])
 
         z = norm * batch_scale + batch_shift
         return z
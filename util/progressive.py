@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import tensorflow as tf
+
+
+def parse_widths(widths):
+    """
+    "64,128" -> [64, 128], an empty string gives no widths
+    """
+    return [int(w) for w in widths.split(",") if w.strip()]
+
+
+def train_progressive(build_model, widths, stage_epochs, epoch, target_l1=0, **train_args):
+    """
+    Train a model at each of widths in turn, each one in a new graph and session built by
+    build_model(sess, width) and started from the variables of the previous width that keep
+    their shape. The widths before the last train for stage_epochs epochs, the last one for
+    epoch epochs or until its val l1_loss reaches target_l1. Returns the sum of the train loop
+    seconds train() reports for every width, or None when the target was not reached
+    """
+    init_from = None
+    passed = 0.0
+    reached = False
+    for i, width in enumerate(widths):
+        last = i == len(widths) - 1
+        tf.reset_default_graph()
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        with tf.Session(config=config) as sess:
+            model = build_model(sess, width)
+            print("Stage: width %d" % width)
+            train_time, reached = model.train(epoch=epoch if last else stage_epochs, init_from=init_from,
+                                              target_l1=target_l1 if last else 0, **train_args)
+            passed += train_time
+            _, init_from = model.get_model_id_and_dir()
+    if not reached:
+        return None
+    return passed
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
+
+
+class StepSchedule(object):
+    """
+    A periodic task of the train loop, due every steps global steps or every seconds
+    of wall clock time since it was last due, whichever comes first. 0 turns a trigger off
+    """
+
+    def __init__(self, steps=0, seconds=0, start_step=0):
+        self.steps = steps
+        self.seconds = seconds
+        self.last_step = start_step
+        self.last_time = time.time()
+
+    def due(self, step):
+        if (self.steps > 0 and step - self.last_step >= self.steps) or \
+                (self.seconds > 0 and time.time() - self.last_time >= self.seconds):
+            self.last_step = step
+            self.last_time = time.time()
+            return True
+        return False
+
+
+def checkpoint_step(checkpoint_path):
+    """
+    Global step of a checkpoint saved with global_step, "font2font.model-1500" -> 1500
+    """
+    return int(checkpoint_path.rsplit("-", 1)[1])
+
+
+class ScalarAverager(object):
+    """
+    Running sums of the losses the train loop fetches anyway, flush writes their means
+    since the last flush as scalar summaries and starts over. Replaces running the merged
+    summary ops every step, the tags stay the same
+    """
+
+    def __init__(self):
+        self.sums = OrderedDict()
+        self.count = 0
+
+    def add(self, **scalars):
+        for tag, value in scalars.items():
+            self.sums[tag] = self.sums.get(tag, 0.0) + float(value)
+        self.count += 1
+
+    def flush(self, summary_writer, step):
+        if not self.count:
+            return
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=total / self.count)
+                                    for tag, total in self.sums.items()])
+        summary_writer.add_summary(summary, step)
+        self.sums = OrderedDict()
+        self.count = 0
+
+
+class BackgroundWriter(object):
+    """
+    One background thread doing the writes handed to it, in order. At most max_pending
+    writes wait, a further one blocks the train loop until the oldest is done. The error
+    of a write is raised by a later submit or by close
+    """
+
+    def __init__(self, max_pending=4):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = deque()
+
+    def submit(self, fn, *args):
+        while self.pending and (self.pending[0].done() or len(self.pending) >= self.max_pending):
+            self.pending.popleft().result()
+        future = self.executor.submit(fn, *args)
+        self.pending.append(future)
+        return future
+
+    def close(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
+
+
+class AsyncSaver(object):
+    """
+    Drop in for tf.train.Saver.save writing the checkpoints on a BackgroundWriter. save
+    copies the variables into shadow variables on the device, only that copy holds up the
+    train loop, and the shadow copy is written meanwhile. The checkpoint keeps the variable
+    names, any tf.train.Saver restores it. Holds a second copy of the saved variables
+    """
+
+    def __init__(self, writer, var_list=None, max_to_keep=3):
+        self.writer = writer
+        var_list = var_list or tf.global_variables()
+        with tf.name_scope("checkpoint_snapshot"):
+            shadows = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False,
+                                   collections=[tf.GraphKeys.LOCAL_VARIABLES]) for v in var_list]
+            self.init = tf.variables_initializer(shadows)
+            self.snapshot = tf.group(*[s.assign(v) for s, v in zip(shadows, var_list)])
+        self.saver = tf.train.Saver(dict((v.op.name, s) for v, s in zip(var_list, shadows)),
+                                    max_to_keep=max_to_keep)
+        self.initialized = False
+        self.last = None
+
+    def save(self, sess, save_path, global_step):
+        """
+        Snapshot the variables and queue the write, returns the path the checkpoint gets
+        """
+        if self.last is not None:
+            # the shadow variables are free again once the previous write is done
+            self.last.result()
+        if not self.initialized:
+            sess.run(self.init)
+            self.initialized = True
+        sess.run(self.snapshot)
+        self.last = self.writer.submit(self.saver.save, sess, save_path, global_step)
+        return "%s-%d" % (save_path, global_step)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+import tensorflow as tf
+from itertools import islice
+from util.dataset import RecordExample, ShuffleBufferProvider, decode_pixels
+
+
+def example_source(examples, next_examples):
+    """
+    Generator over the (example, augmentation seed) pairs next_examples() gives on every pass,
+    and whether it yields encoded bytes, decoded in the pipeline, or the uint8 [H, 2W] pixels of
+    array examples. The examples of a ShuffleBufferProvider are streamed record bytes
+    """
+    streaming = isinstance(examples, ShuffleBufferProvider)
+    encoded = streaming or all(isinstance(e, (bytes, RecordExample)) for e in examples)
+
+    def generate():
+        for e, seed in next_examples():
+            if isinstance(e, RecordExample):
+                yield e.records.read(e.index), seed
+            elif encoded:
+                yield e, seed
+            else:
+                yield decode_pixels(e).astype(np.uint8), seed
+
+    return generate, encoded
+
+
+def augment_pair(pair, width, seed):
+    """
+    Enlarge a [width, width, 2] target and source pair by a random 1.00-1.20 and random crop
+    it back to its original size, both images get the same scale and crop. The random numbers
+    are a function of seed, a [2] int64 tensor, so a replayed batch gets the same augmentation
+    """
+    rand = tf.contrib.stateless.stateless_random_uniform([3], seed)
+    multiplier = 1.00 + 0.20 * rand[0]
+    # add an eps to prevent cropping issue
+    size = tf.cast(multiplier * width, tf.int32) + 1
+    enlarged = tf.image.resize_images(pair, [size, size])
+    offsets = tf.minimum(tf.cast(rand[1:] * tf.cast(size - width + 1, tf.float32), tf.int32), size - width)
+    return tf.slice(enlarged, [offsets[0], offsets[1], 0], [width, width, 2])
+
+
+def pipeline_batch(batch_size, width, uint8=False):
+    """
+    Local variable holding the current batch of a TrainPipeline, [B, W, W, 2] float32 or
+    [B, W, 2W] uint8 with uint8. The model takes it as the default of its input placeholders
+    when the graph is built, the pipeline loading it is built later from the examples train() reads
+    """
+    shape = [batch_size, width, 2 * width] if uint8 else [batch_size, width, width, 2]
+    return tf.Variable(tf.zeros(shape, dtype=tf.uint8 if uint8 else tf.float32), trainable=False,
+                       collections=[tf.GraphKeys.LOCAL_VARIABLES], name="pipeline_batch")
+
+
+class TrainPipeline(object):
+    """
+    tf.data input of the training examples, or of the shards a ShuffleBufferProvider streams:
+    decoding on num_parallel_calls threads, an optional shuffle buffer on top of the shuffled
+    order, augmentation seeded by the batch seeds of the epoch, batching and prefetching.
+    load pulls the next batch into a local variable, so the session runs of one training step
+    share it, batch is the default of the input placeholders, a pipeline_batch of the model when
+    given. Batches are [B, W, W, 2] in (-1, 1), or [B, W, 2W] uint8 with uint8. An incomplete
+    last batch of an epoch is dropped.
+    """
+
+    def __init__(self, examples, batch_size, width, uint8=False, augment=True, shuffle_buffer=0,
+                 num_parallel_calls=4, prefetch=2, batch=None):
+        self.examples = examples
+        self.streaming = isinstance(examples, ShuffleBufferProvider)
+        self.num_examples = examples.count if self.streaming else len(examples)
+        self.batch_size = batch_size
+        self.order = None
+        self.seeds = None
+        self.rng = None
+        self.start = 0
+        generate, encoded = example_source(examples, self.next_examples)
+        if encoded:
+            shape = tf.TensorShape([])
+        else:
+            shape = tf.TensorShape([width, 2 * width])
+        dataset = tf.data.Dataset.from_generator(generate, (tf.string if encoded else tf.uint8, tf.int64),
+                                                 (shape, tf.TensorShape([2])))
+        if shuffle_buffer > 0:
+            dataset = dataset.shuffle(shuffle_buffer)
+
+        def prepare(example, seed):
+            if encoded:
+                example = tf.reshape(tf.image.decode_image(example, channels=1), [width, 2 * width])
+            pixels = tf.cast(example, tf.float32)
+            pair = tf.stack([pixels[:, :width], pixels[:, width:]], axis=2)
+            if augment:
+                pair = augment_pair(pair, width, seed)
+            if uint8:
+                return tf.cast(tf.round(tf.concat([pair[:, :, 0], pair[:, :, 1]], axis=1)), tf.uint8)
+            return pair / 127.5 - 1.
+
+        dataset = dataset.map(prepare, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.batch(batch_size, drop_remainder=True).prefetch(prefetch)
+        self.iterator = dataset.make_initializable_iterator()
+
+        self.batch = batch if batch is not None else pipeline_batch(batch_size, width, uint8=uint8)
+        self.load = self.batch.assign(self.iterator.get_next())
+        self.total_batches = self.num_examples // batch_size
+
+    def next_examples(self):
+        """
+        (example, seed) pairs of the epoch batch_iter set up, the augmentation seed of an example
+        is the seed of its batch and its position in the batch
+        """
+        if self.streaming:
+            examples = islice(self.examples.stream(self.rng), self.start * self.batch_size, None)
+        else:
+            examples = (self.examples[i] for i in self.order)
+        for i, e in enumerate(examples):
+            yield e, np.array([self.seeds[i // self.batch_size], i % self.batch_size], dtype=np.int64)
+
+    def batch_iter(self, sess, order=None, seeds=None, rng=None, start=0):
+        """
+        Load the batches of one epoch one after the other, yields None for every loaded batch,
+        the training step then runs on it without feeding the input placeholders. order are the
+        example indices of the epoch and seeds the augmentation seeds of its batches, e.g. of an
+        EpochSampler, by default a random permutation and random seeds. A streamed epoch is
+        shuffled by rng, its batch seeds are drawn from rng first as for the batches of
+        TrainDataProvider.get_train_iter, and it starts at batch start
+        """
+        num_batches = -(-self.num_examples // self.batch_size)
+        if self.streaming:
+            self.rng = rng if rng is not None else np.random.RandomState()
+            seeds = self.rng.randint(0, 2 ** 31 - 1, size=num_batches)[start:]
+        else:
+            self.order = order if order is not None else np.random.permutation(self.num_examples)
+        if seeds is None:
+            seeds = np.random.randint(0, 2 ** 31 - 1, size=num_batches)
+        self.seeds = seeds
+        self.start = start
+        sess.run([self.iterator.initializer, self.batch.initializer])
+        while True:
+            try:
+                sess.run(self.load)
+            except tf.errors.OutOfRangeError:
+                return
+            yield None
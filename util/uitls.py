@@ -41,8 +41,15 @@ def normalize_image(img):
 #     return normalized
 
 
+def read_image(img):
+    return misc.imread(img).astype(np.float)
+
+
 def read_split_image(img):
-    mat = misc.imread(img).astype(np.float)
+    return split_image(read_image(img))
+
+
+def split_image(mat):
     side = int(mat.shape[1] / 2)
     assert side * 2 == mat.shape[1]
     img_A = mat[:, :side]  # target
@@ -72,6 +79,15 @@ def merge(images, size):
     return img
 
 
+def save_sample_pair(real_imgs, fake_imgs, rows, img_path):
+    """
+    Save a batch of real images next to the generated ones, column by column
+    """
+    merged_real_images = merge(scale_back(real_imgs), [rows, 1])
+    merged_fake_images = merge(scale_back(fake_imgs), [rows, 1])
+    misc.imsave(img_path, np.concatenate([merged_real_images, merged_fake_images], axis=1))
+
+
 def save_concat_images(imgs, img_path):
     concated = np.concatenate(imgs, axis=1)
     misc.imsave(img_path, concated)